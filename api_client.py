@@ -0,0 +1,237 @@
+import json
+import socket
+import threading
+import http.client
+from urllib.parse import urlsplit, urlencode
+
+
+class APIError(Exception):
+    '''
+        error response of the api
+            - status_code: http status (e.g., 429 when throttled)
+            - retry_after: seconds to wait before retrying, from the Retry-After headers (None if absent)
+    '''
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class RequestCancelled(Exception):
+    pass
+
+class RequestHandle:
+    '''
+        handle of a request in flight, to cancel it from another thread (e.g., the slower of two hedged requests):
+        cancel() shuts its socket down, which interrupts the request with RequestCancelled
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sock = None
+        self.cancelled = False
+
+    def attach(self, sock):
+        # the socket of the request once connected (kept by the response of a stream after the connection hands it over)
+        with self.lock:
+            self.sock = sock
+            cancelled = self.cancelled
+        if cancelled:
+            self._shutdown(sock)
+
+    def detach(self):
+        with self.lock:
+            self.sock = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            sock = self.sock
+        if sock is not None:
+            self._shutdown(sock)
+
+    @staticmethod
+    def _shutdown(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _get_retry_after(response):
+    # azure also reports it in milliseconds; only the delay-seconds form of Retry-After is used
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = response.getheader(header)
+        if value is not None:
+            try:
+                return float(value) / scale
+            except ValueError:
+                pass
+    return None
+
+
+class ConnectionPool:
+    '''
+        keep-alive http(s) connections to one host, reused across requests
+            - size: max number of connections in use at once (further requests wait for one to be released)
+            - timeout: socket timeout (in seconds) of each connection
+    '''
+    def __init__(self, host, port, https, size=10, timeout=600):
+        self.host = host
+        self.port = port
+        self.https = https
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(size, 1))
+        self.num_connections = 0 # opened so far
+        self.closed = False
+
+    def acquire(self):
+        # return: (connection, whether it was reused)
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.num_connections += 1
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, conn, reuse=True):
+        with self.lock:
+            reuse = reuse and not self.closed
+            if reuse:
+                self.idle.append(conn)
+        if not reuse:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        # close the idle connections, and those in use once they are released
+        with self.lock:
+            self.closed = True
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class CompletionStream:
+    '''
+        chunks of a streamed completion (server-sent events: "data: <chunk>" lines, until "data: [DONE]");
+        the connection goes back to the pool at the end of the stream, and is dropped by close() before the end,
+        which cancels the generation
+    '''
+    def __init__(self, pool, conn, response, handle=None):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.handle = handle
+        self.released = False
+
+    def __iter__(self):
+        try:
+            for line in self.response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    self.response.read()
+                    self._release(reuse=not self.response.will_close)
+                    return
+                yield json.loads(data)
+        except Exception as e:
+            self._release(reuse=False)
+            if self.handle is not None and self.handle.cancelled:
+                raise RequestCancelled() from e
+            raise
+        self._release(reuse=False)
+        if self.handle is not None and self.handle.cancelled: # the shut down socket ended the stream early
+            raise RequestCancelled()
+
+    def _release(self, reuse):
+        if not self.released:
+            self.released = True
+            if self.handle is not None:
+                self.handle.detach()
+            self.pool.release(self.conn, reuse=reuse)
+
+    def close(self):
+        self._release(reuse=False)
+
+
+class ChatCompletionsClient:
+    '''
+        client of the chat completions api (OpenAI or Azure OpenAI) that owns its endpoint, key and connection pool,
+        so that clients of different endpoints / keys can coexist in one process
+            - api_type: "azure" (deployment urls, api-key header) or "open_ai"
+            - api_base: e.g., https://<resource>.openai.azure.com, or a local stub server (scripts/stub_chat_server.py)
+            - pool_size: max number of concurrent requests, each on a pooled keep-alive connection
+            - timeout: socket timeout (in seconds) of each request
+        create(engine, stream=False, handle=None, **params): the response, or a CompletionStream; raises APIError on error
+        responses, and RequestCancelled if the request is cancelled through its RequestHandle
+    '''
+    def __init__(self, api_key, api_base=None, api_type="open_ai", api_version=None, pool_size=10, timeout=600):
+        self.api_type = api_type
+        self.api_version = api_version
+        if api_type == "azure":
+            self.headers = {"api-key": api_key or ""}
+        else:
+            self.headers = {"Authorization": f"Bearer {api_key}"}
+            api_base = api_base or "https://api.openai.com/v1"
+        self.api_base = api_base
+        self.headers["Content-Type"] = "application/json"
+        url = urlsplit(api_base)
+        self.base_path = url.path.rstrip("/")
+        self.pool = ConnectionPool(url.hostname, url.port, url.scheme == "https", size=pool_size, timeout=timeout)
+
+    def _get_path(self, engine):
+        if self.api_type == "azure":
+            return f"{self.base_path}/openai/deployments/{engine}/chat/completions?" + urlencode({"api-version": self.api_version})
+        return f"{self.base_path}/chat/completions"
+
+    def _release(self, conn, reuse, handle=None):
+        if handle is not None:
+            handle.detach()
+        self.pool.release(conn, reuse=reuse)
+
+    def _send(self, path, body, handle=None):
+        while True:
+            if handle is not None and handle.cancelled:
+                raise RequestCancelled()
+            conn, reused = self.pool.acquire()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                if handle is not None:
+                    handle.attach(conn.sock)
+                conn.request("POST", path, body=body, headers=self.headers)
+                return conn, conn.getresponse()
+            except Exception as e:
+                self._release(conn, False, handle)
+                if handle is not None and handle.cancelled:
+                    raise RequestCancelled() from e
+                # the server may have closed a pooled connection while it was idle: retry on another one
+                if reused and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise
+
+    def create(self, engine, stream=False, handle=None, **params):
+        if self.api_type != "azure":
+            params["model"] = engine
+        if stream:
+            params["stream"] = True
+        conn, response = self._send(self._get_path(engine), json.dumps(params).encode("utf-8"), handle)
+        if response.status != 200 or not stream:
+            try:
+                data = response.read()
+            except Exception as e:
+                self._release(conn, False, handle)
+                if handle is not None and handle.cancelled:
+                    raise RequestCancelled() from e
+                raise
+            self._release(conn, not response.will_close, handle)
+            if response.status != 200:
+                raise APIError(response.status, data.decode("utf-8", errors="replace"), _get_retry_after(response))
+            return json.loads(data)
+        return CompletionStream(self.pool, conn, response, handle)
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from urllib.request import pathname2url
+
+
+CACHE_MODES = ['bypass', 'read_only', 'write_through']
+
+class ResponseCache:
+    '''
+        persistent on-disk (sqlite) cache of model responses, keyed by a hash of the full request
+            - mode: 'read_only' only serves cached responses, from a read-only connection (nothing is created or
+              written; a missing cache file serves nothing); 'write_through' also stores new ones
+            - max_size_mb: when the stored responses exceed this size, the least recently used ones are evicted; the
+              total size is kept as a running count (summed once at startup), and re-summed before evicting, since
+              other processes may share the cache
+    '''
+    def __init__(self, path, mode="write_through", max_size_mb=None):
+        assert mode in ['read_only', 'write_through'], f"unknown cache mode {mode}"
+        self.path = path
+        self.mode = mode
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        # may be shared by several worker processes
+        if mode == 'read_only':
+            self.conn = self._connect_read_only(path)
+        else:
+            if os.path.dirname(path) != "":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)")
+            self.conn.commit()
+        self.lock = threading.Lock()
+        self.total_size = self._get_total_size() if self.max_size is not None and mode == 'write_through' else None
+        # hit / miss counters
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _connect_read_only(path):
+        # None if there is no cache to read (no file, or no responses table)
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect("file:" + pathname2url(os.path.abspath(path)) + "?mode=ro", uri=True, check_same_thread=False, timeout=60)
+        if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'responses'").fetchone() is None:
+            conn.close()
+            return None
+        return conn
+
+    @staticmethod
+    def make_key(request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, request):
+        key = self.make_key(request)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone() if self.conn is not None else None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == 'write_through':
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, request, response):
+        if self.mode != 'write_through':
+            return
+        key = self.make_key(request)
+        value = json.dumps(response)
+        with self.lock:
+            if self.max_size is not None:
+                row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self.total_size += len(value) - (row[0] if row is not None else 0)
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            self.conn.commit()
+            if self.max_size is not None and self.total_size > self.max_size:
+                self._evict()
+
+    def _get_total_size(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        total_size = self._get_total_size()
+        if total_size <= self.max_size:
+            self.total_size = total_size
+            return
+        # drop least recently used entries until the cache fits
+        to_delete = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            if total_size <= self.max_size:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.conn.commit()
+        self.total_size = total_size
+
+    def stats(self):
+        return {"cache_hits": self.hits, "cache_misses": self.misses}
@@ -1,5 +1,3 @@
-import torch
-
 # TODO: add your custom model config here:
 gpt_configs = {
     "gpt4-32k": {
@@ -22,29 +20,58 @@ gpt_configs = {
     }
 }
 
+# requests-per-minute / tokens-per-minute quota of each gpt engine (None means unlimited)
+# TODO: set these to the quota of your own deployment (or pass --rpm / --tpm)
+gpt_rate_limits = {
+    "gpt4-32k": {
+        "rpm": None,
+        "tpm": None
+    },
+    "gpt35-turbo": {
+        "rpm": None,
+        "tpm": None
+    }
+}
+
+# price of each gpt engine (USD per 1K tokens), used for the reported and the estimated (--dry_run) cost
+# TODO: set these to the price of your own deployment
+gpt_token_prices = {
+    "devgpt4-32k": {
+        "prompt": 0.06,
+        "completion": 0.12
+    },
+    "mtutor-openai-dev": {
+        "prompt": 0.0015,
+        "completion": 0.002
+    }
+}
+
 llama_configs = {
     "meta-llama/Llama-2-7b-chat-hf": {
         "task": "text-generation",
         "model": "meta-llama/Llama-2-7b-chat-hf",
-        "torch_dtype": torch.float16,
+        "torch_dtype": "float16", # resolved when the model is loaded (models.resolve_torch_dtype)
         "device_map": "auto",
         "do_sample":False,
+        "max_new_tokens": 1024,
     },
     "meta-llama/Llama-2-13b-chat-hf": {
         "task": "text-generation",
         "model": "meta-llama/Llama-2-13b-chat-hf",
-        "torch_dtype": torch.float16,
+        "torch_dtype": "float16",
         "device_map": "auto",
         "do_sample":False,
+        "max_new_tokens": 1024,
     }
 }
 
 default_llama_config = {
     "task": "text-generation",
     "model": None,
-    "torch_dtype": torch.float16,
+    "torch_dtype": "float16",
     "device_map": "auto",
     "do_sample":False,
+    "max_new_tokens": 1024,
 }
 
 default_gpt_config = {
@@ -55,4 +82,9 @@ default_gpt_config = {
     "frequency_penalty": 0.0,
     "presence_penalty": 0.0,
     "stop": None
+}
+
+default_gpt_rate_limit = {
+    "rpm": None,
+    "tpm": None
 }
\ No newline at end of file
@@ -0,0 +1,163 @@
+import time
+import argparse
+from tasks import get_task
+from prompts.registry import get_prompt_methods
+from models import get_token_counter, compute_gpt_cost, MAX_GENERATIONS_PER_CALL
+from configs import gpt_configs, llama_configs, default_gpt_config, default_llama_config
+
+
+HINT_WORD_PLACEHOLDER = "hint" # the guesser prompt needs the spymaster hint word, unknown before running
+
+DEFAULT_TASK_DATA_FILES = {
+    "trivia_creative_writing": "trivia_creative_writing_100_n_5.jsonl",
+    "logic_grid_puzzle": "logic_grid_puzzle_200.jsonl",
+    "codenames_collaborative": "codenames_50.jsonl"
+}
+
+# loaded tasks and token counts are shared by all the configurations estimated in the process
+_tasks = {}
+_num_tokens = {}
+
+def _get_task(task_name, task_data_file):
+    if (task_name, task_data_file) not in _tasks:
+        _tasks[(task_name, task_data_file)] = get_task(task_name, task_data_file)
+    return _tasks[(task_name, task_data_file)]
+
+def _count_tokens(text, token_counter):
+    name, count = token_counter
+    if (name, text) not in _num_tokens:
+        _num_tokens[(name, text)] = count(text)
+    return _num_tokens[(name, text)]
+
+def _get_token_counter(args):
+    # tokenizer of the model (see models.get_token_counter)
+    if args['model_type'] == 'llama2':
+        llama_config = args.get('llama_config', llama_configs.get(args['model'], default_llama_config))
+        return get_token_counter('llama2', llama_config['model'] or args['model'])
+    return get_token_counter(args['model_type'])
+
+def _get_max_tokens(args):
+    # max completion tokens of one generation
+    if args['model_type'] == 'llama2':
+        llama_config = args.get('llama_config', llama_configs.get(args['model'], default_llama_config))
+        return llama_config['max_new_tokens']
+    return args.get('gpt_config', gpt_configs.get(args['model'], default_gpt_config))['max_tokens']
+
+def _get_self_refine_prompt_tokens(init_tokens, feedback_tokens, refine_tokens, max_tokens, num_refine, context_policy, context_token_budget):
+    '''
+        prompt tokens of the calls of a self-refine chain (see run._run_self_refine_default), assuming every answer
+        and feedback is max_tokens long
+            - init_tokens: the initial prompt (the question)
+            - feedback_tokens / refine_tokens: the feedback / refine templates without the context and the feedback
+    '''
+    prompt_tokens = [init_tokens]
+    history = [max_tokens] # A0, then F + A of each round
+    for j in range(num_refine):
+        if context_policy == "latest":
+            context_tokens = init_tokens + max_tokens
+        elif context_policy == "window":
+            # most recent rounds that fit in the budget, at least the latest one (see run._get_context_prompt)
+            context_tokens = init_tokens
+            start = len(history)
+            while start > 0:
+                if start < len(history) and context_tokens + history[start-1] > context_token_budget:
+                    break
+                context_tokens += history[start-1]
+                start -= 1
+        else:
+            context_tokens = init_tokens + sum(history)
+        prompt_tokens.append(feedback_tokens + context_tokens)
+        prompt_tokens.append(refine_tokens + context_tokens + max_tokens)
+        history.append(refine_tokens + 2 * max_tokens)
+    return prompt_tokens
+
+def estimate_run(args):
+    '''
+        worst-case estimate of a run configuration (same args as run.run) without calling any model: every prompt is
+        rendered and tokenized locally, every generation is assumed to be max_tokens long
+        returns the number of instances, model calls, prompt tokens, max completion tokens, prompt cost and max cost,
+        and the tokenizer that counted the tokens (approximate if the model's tokenizer is not available)
+    '''
+    task_name, method = args['task'], args['method']
+    task = _get_task(task_name, args['task_data_file'])
+    max_tokens = _get_max_tokens(args)
+    token_counter = _get_token_counter(args)
+    num_generation, num_refine = args['num_generation'], args['num_refine']
+    start = max(args['task_start_index'], 0)
+    end = min(args['task_end_index'], len(task))
+
+    # (prompt tokens, number of generations) of every request
+    requests = []
+    for i in range(start, end):
+        if task_name == 'codenames_collaborative':
+            # two-stage flow: one spymaster hint, then the guesser generations
+            roles = [{"role": "spymaster"}, {"role": "guesser", "hint_word": HINT_WORD_PLACEHOLDER}]
+        else:
+            roles = [{}]
+        for role_kwargs in roles:
+            if method == "self_refine":
+                init_tokens = _count_tokens(task.get_input_prompt(i, method=method, phase="init", **role_kwargs), token_counter)
+                feedback_tokens = _count_tokens(task.get_input_prompt(i, method=method, phase="feedback", question_answer="", **role_kwargs), token_counter)
+                refine_tokens = _count_tokens(task.get_input_prompt(i, method=method, phase="refine", question_answer="", feedback="", **role_kwargs), token_counter)
+                for prompt_tokens in _get_self_refine_prompt_tokens(init_tokens, feedback_tokens, refine_tokens, max_tokens, num_refine, args['context_policy'], args['context_token_budget']):
+                    requests.append((prompt_tokens, 1))
+            else:
+                n = 1 if role_kwargs.get("role") == "spymaster" else num_generation
+                requests.append((_count_tokens(task.get_input_prompt(i, method=method, **role_kwargs), token_counter), n))
+
+    system_tokens = _count_tokens(args['system_message'], token_counter) if args['system_message'] != "" else 0
+    num_calls, prompt_tokens, completion_tokens = 0, 0, 0
+    for request_prompt_tokens, n in requests:
+        # gpt splits the generations of a request into api calls that each send the prompt
+        calls = -(-n // MAX_GENERATIONS_PER_CALL) if args['model_type'] == 'gpt' else 1
+        num_calls += calls
+        prompt_tokens += calls * (request_prompt_tokens + system_tokens)
+        completion_tokens += n * max_tokens
+
+    if args['model_type'] == 'gpt':
+        engine = args.get('gpt_config', gpt_configs.get(args['model'], default_gpt_config))['engine'] or args['model']
+        prompt_cost = compute_gpt_cost(engine, prompt_tokens, 0)
+        max_cost = compute_gpt_cost(engine, prompt_tokens, completion_tokens)
+    else:
+        prompt_cost, max_cost = 0, 0
+    return {
+        "num_instances": end - start,
+        "num_calls": num_calls,
+        "prompt_tokens": prompt_tokens,
+        "max_completion_tokens": completion_tokens,
+        "prompt_cost": prompt_cost,
+        "max_cost": max_cost,
+        "token_counter": token_counter[0]
+    }
+
+
+def parse_args():
+    model_choices = list(gpt_configs.keys()) + list(llama_configs.keys())
+    args = argparse.ArgumentParser()
+    args.add_argument('--models', type=str, nargs='+', choices=model_choices, default=list(gpt_configs.keys()))
+    args.add_argument('--methods', type=str, nargs='+', choices=get_prompt_methods(), default=['standard','cot','spp'])
+    args.add_argument('--tasks', type=str, nargs='+', choices=list(DEFAULT_TASK_DATA_FILES.keys()), default=list(DEFAULT_TASK_DATA_FILES.keys()))
+    args.add_argument('--task_start_index', type=int, default=0)
+    args.add_argument('--task_end_index', type=int, default=1000000) # default: all instances
+    args.add_argument('--num_generation', type=int, default=1)
+    args.add_argument('--system_message', type=str, default="")
+    args.add_argument('--num_refine', type=int, default=1)
+    args.add_argument('--context_policy', type=str, choices=['full', 'latest', 'window'], default='full')
+    args.add_argument('--context_token_budget', type=int, default=4096)
+    args = args.parse_args()
+    return args
+
+if __name__ == '__main__':
+    # sweep: estimate every (task, method, model) configuration on the default data file of each task
+    args = vars(parse_args())
+    start_time = time.time()
+    total_cost = 0
+    for task_name in args['tasks']:
+        for method in args['methods']:
+            for model in args['models']:
+                run_args = dict(args, task=task_name, task_data_file=DEFAULT_TASK_DATA_FILES[task_name], method=method, model=model,
+                                model_type='llama2' if model in llama_configs else 'gpt')
+                estimate = estimate_run(run_args)
+                total_cost += estimate["max_cost"]
+                print(f"{task_name} | {method} | {model} |", estimate)
+    print(f"total max cost: {total_cost:.2f} | estimated in {time.time() - start_time:.2f}s")
@@ -0,0 +1,300 @@
+import os
+import glob
+import gzip
+import json
+import hashlib
+
+
+# log formats: suffix added to the .jsonl log file; gzip / zstd logs are compact (see CompactLogCodec)
+LOG_FORMATS = {"jsonl": "", "gzip": ".gz", "zstd": ".zst"}
+
+PROMPT_STORE_DIR = "prompt_store" # side store of the compact logs, next to the log files
+MIN_PROMPT_PREFIX_LENGTH = 256 # shorter template prefixes are kept inline
+
+def get_log_format(log_file):
+    for log_format, suffix in LOG_FORMATS.items():
+        if suffix != "" and log_file.endswith(".jsonl" + suffix):
+            return log_format
+    return "jsonl"
+
+def open_log(log_file, mode="r", log_format=None):
+    # text-mode file object of a log, (de)compressed according to its suffix (or the given format)
+    log_format = log_format or get_log_format(log_file)
+    if log_format == "gzip":
+        return gzip.open(log_file, mode + "t", encoding="utf-8")
+    if log_format == "zstd":
+        import zstandard # optional, only needed for zstd logs
+        return zstandard.open(log_file, mode + "t", encoding="utf-8")
+    return open(log_file, mode)
+
+def find_log_files(log_dir):
+    # log files of every format under log_dir (recursively)
+    log_files = []
+    for suffix in LOG_FORMATS.values():
+        log_files.extend(glob.glob(os.path.join(log_dir, "**", "*.jsonl" + suffix), recursive=True))
+    return sorted(log_files)
+
+def find_shard_log_files(log_file):
+    # shard files of a sharded run (see run._run_sharded) that were not merged into log_file
+    return sorted(glob.glob(glob.escape(log_file) + ".shard*"))
+
+
+class PromptStore:
+    '''
+        content-addressed store of prompt texts (e.g., the SPP demonstrations shared by all the prompts of a method):
+        one file per text, named by its sha256, written once
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.texts = {}
+
+    def put(self, text):
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if key not in self.texts:
+            path = os.path.join(self.store_dir, key + ".txt")
+            if not os.path.exists(path):
+                os.makedirs(self.store_dir, exist_ok=True)
+                tmp_path = path + f".tmp{os.getpid()}"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(tmp_path, path)
+            self.texts[key] = text
+        return key
+
+    def get(self, key):
+        if key not in self.texts:
+            with open(os.path.join(self.store_dir, key + ".txt"), "r", encoding="utf-8") as f:
+                self.texts[key] = f.read()
+        return self.texts[key]
+
+
+class CompactLogCodec:
+    '''
+        deduplicated record shape of the compact (gzip / zstd) logs
+            - the run config (the args merged into every record) is kept once, in the header record of the log;
+              records only keep the config fields whose value differs
+            - the prompts logged with each raw response are stored as {"prefix": key, "text": rest}, where the
+              prefix is the longest template prefix of the task, kept in the PromptStore next to the log file
+        decode(encode(log)) gives back the record as logged by run.py (same fields, same order)
+    '''
+    def __init__(self, log_file, config, task=None):
+        self.config = config
+        self.task = task or config.get("task")
+        self.store = PromptStore(os.path.join(os.path.dirname(log_file), PROMPT_STORE_DIR))
+        self.prefixes = []
+        if self.task is not None:
+            from prompts.registry import get_prompt_prefixes
+            self.prefixes = get_prompt_prefixes(self.task, min_length=MIN_PROMPT_PREFIX_LENGTH)
+
+    @property
+    def header(self):
+        return {"log_header": {"config": self.config, "task": self.task, "prompt_store": PROMPT_STORE_DIR}}
+
+    def encode(self, log):
+        record = {key: value for key, value in log.items() if key not in self.config or value != self.config[key]}
+        return self._encode_prompts(record)
+
+    def _encode_prompts(self, value):
+        if isinstance(value, list):
+            return [self._encode_prompts(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        encoded = {key: self._encode_prompts(v) for key, v in value.items()}
+        prompt = value.get("prompt")
+        if isinstance(prompt, str):
+            for prefix in self.prefixes:
+                if prompt.startswith(prefix):
+                    encoded["prompt"] = {"prefix": self.store.put(prefix), "text": prompt[len(prefix):]}
+                    break
+        return encoded
+
+    def decode(self, record):
+        record = self._decode_prompts(record)
+        # logged as: run outputs, then the run config, then the task data (see run._add_run_info)
+        log = {key: value for key, value in record.items() if key not in self.config and key != "task_data"}
+        for key, value in self.config.items():
+            log[key] = record.get(key, value)
+        if "task_data" in record:
+            log["task_data"] = record["task_data"]
+        return log
+
+    def _decode_prompts(self, value):
+        if isinstance(value, list):
+            return [self._decode_prompts(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        decoded = {key: self._decode_prompts(v) for key, v in value.items()}
+        prompt = value.get("prompt")
+        if isinstance(prompt, dict) and "prefix" in prompt:
+            decoded["prompt"] = self.store.get(prompt["prefix"]) + prompt["text"]
+        return decoded
+
+
+def get_log_codec(log_file, config, task=None):
+    # codec of a log file written with the given run config; None for plain jsonl logs
+    if get_log_format(log_file) == "jsonl":
+        return None
+    # same serialization as the config fields of the records (see run._add_run_info)
+    return CompactLogCodec(log_file, json.loads(json.dumps(config, default=str)), task)
+
+def read_log_lines(log_file):
+    '''
+        return: (codec of the log header, or None for plain jsonl logs; the stored record lines)
+    '''
+    with open_log(log_file, "r") as f:
+        lines = f.readlines()
+    codec = None
+    if lines:
+        try:
+            first = json.loads(lines[0])
+        except json.JSONDecodeError:
+            first = None
+        if isinstance(first, dict) and "log_header" in first:
+            codec = CompactLogCodec(log_file, first["log_header"]["config"], first["log_header"].get("task"))
+            lines = lines[1:]
+    return codec, lines
+
+def read_logs(log_file):
+    '''
+        records of a log file of any format, in the shape logged by run.py;
+        a partially written last line is skipped
+    '''
+    codec, lines = read_log_lines(log_file)
+    for line in lines:
+        if line.strip() == "":
+            continue
+        try:
+            log = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        yield codec.decode(log) if codec is not None else log
+
+
+class JsonlLogWriter:
+    '''
+        append-only jsonl log writer: each record is serialized once and appended to the file;
+        the file is flushed and fsync-ed every `fsync_every` records (and on close), so a crash
+        can lose at most the last unsynced group instead of truncating the whole log.
+            - codec: records are stored encoded (compact logs and their shard files)
+            - header: written first when creating the file
+    '''
+    def __init__(self, log_file, mode="w", fsync_every=1, codec=None, header=None):
+        self.log_file = log_file
+        self.fsync_every = max(fsync_every, 1)
+        self.codec = codec
+        self.f = open_log(log_file, mode)
+        self.num_unsynced = 0
+        if header is not None and mode == "w":
+            self.f.write(json.dumps(header) + "\n")
+
+    def write(self, log):
+        line = json.dumps(self.codec.encode(log) if self.codec is not None else log) + "\n"
+        self.f.write(line)
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every:
+            self.sync()
+        return line
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.num_unsynced = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_log_idx(log):
+    # default/codenames records carry "idx" at the top level; self-refine chains only inside each step
+    if "idx" in log:
+        return log["idx"]
+    if "answer_0" in log:
+        return log["answer_0"]["idx"]
+    return None
+
+def is_completed_log(log, num_refine=1):
+    # failed model calls leave a record without "idx" (only the run args and task data), or with fewer generations
+    # than requested when only some of the calls of an instance failed ("partial")
+    if log.get("partial"):
+        return False
+    if "idx" in log:
+        return True
+    # self-refine chains are done once the final refined answer is there
+    return f"answer_{num_refine}" in log
+
+def load_completed_logs(log_file, num_refine=1, codec=None):
+    '''
+        return {idx: raw jsonl line} for the completed records of an existing log file;
+        failed records and a partially written last line are skipped
+            - codec: the lines are returned encoded with this codec (None: plain records); records of a compact
+              log written with another run config are re-encoded
+    '''
+    completed_logs = {}
+    file_codec, lines = read_log_lines(log_file)
+    reencode = file_codec is not None and (codec is None or file_codec.config != codec.config)
+    for line in lines:
+        try:
+            log = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if is_completed_log(log, num_refine):
+            if reencode:
+                log = file_codec.decode(log)
+                line = json.dumps(codec.encode(log) if codec is not None else log)
+            completed_logs[get_log_idx(log)] = line if line.endswith("\n") else line + "\n"
+    return completed_logs
+
+def rewrite_log_lines(log_file, lines, header=None):
+    # atomically replace the log file with already serialized lines (after the header of compact logs)
+    tmp_file = log_file + ".tmp"
+    with open_log(tmp_file, "w", get_log_format(log_file)) as f:
+        if header is not None:
+            f.write(json.dumps(header) + "\n")
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, log_file)
+
+def _get_shared_config(logs):
+    # run config of plain records: the trailing fields (before the task data) with the same value in every record
+    fields = [[key for key in log if key != "task_data"] for log in logs]
+    config = {}
+    for depth in range(1, min(len(keys) for keys in fields) + 1):
+        key = fields[0][-depth]
+        if not all(keys[-depth] == key and log[key] == logs[0][key] for keys, log in zip(fields, logs)):
+            break
+        config[key] = logs[0][key]
+    return dict(reversed(list(config.items())))
+
+def convert_log_file(log_file, log_format):
+    '''
+        write a copy of a log file in another format (next to it, same name with the suffix of the format)
+        return: the new log file
+    '''
+    logs = list(read_logs(log_file))
+    output_file = log_file[:log_file.rindex(".jsonl")] + ".jsonl" + LOG_FORMATS[log_format]
+    codec = get_log_codec(output_file, _get_shared_config(logs), logs[0].get("task")) if logs else None
+    lines = [json.dumps(codec.encode(log) if codec is not None else log) + "\n" for log in logs]
+    rewrite_log_lines(output_file, lines, header=codec.header if codec is not None else None)
+    return output_file
+
+
+if __name__ == '__main__':
+    import argparse
+    args = argparse.ArgumentParser()
+    args.add_argument('paths', type=str, nargs='+') # log files, or directories searched recursively for logs
+    args.add_argument('--log_format', type=str, choices=list(LOG_FORMATS.keys()), required=True)
+    args = vars(args.parse_args())
+    for path in args['paths']:
+        for log_file in (find_log_files(path) if os.path.isdir(path) else [path]):
+            if get_log_format(log_file) != args['log_format']:
+                output_file = convert_log_file(log_file, args['log_format'])
+                print(f"{log_file} ({os.path.getsize(log_file)} bytes) -> {output_file} ({os.path.getsize(output_file)} bytes)")
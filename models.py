@@ -1,5 +1,4 @@
 import os
-import openai
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -8,13 +7,40 @@ from tenacity import (
  
 import logging  
 
-from transformers import AutoTokenizer
-import transformers
-import torch
 import uuid
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from configs import gpt_token_prices
+from log_utils import find_log_files, read_logs
+from api_client import ChatCompletionsClient, APIError, RequestHandle
 
 
 
+# heavy backend dependencies, imported when a backend is instantiated (see _load_llama_backend) so
+# that gpt runs and analysis scripts do not pay for torch / transformers
+torch = None
+transformers = None
+_backend_lock = threading.Lock()
+
+def _load_llama_backend():
+    global torch, transformers
+    with _backend_lock:
+        if transformers is None:
+            import torch as torch_module
+            import transformers as transformers_module
+            torch, transformers = torch_module, transformers_module
+    return torch, transformers
+
+def resolve_torch_dtype(dtype):
+    # dtypes are kept as strings in the configs (e.g., "float16"), resolved once torch is loaded; "auto" is kept
+    if not isinstance(dtype, str) or dtype == "auto":
+        return dtype
+    torch, _ = _load_llama_backend()
+    return getattr(torch, dtype.split(".")[-1])
+
+
 # Configure logging  
 logging.basicConfig(level=logging.INFO)  
   
@@ -22,7 +48,291 @@ logging.basicConfig(level=logging.INFO)
 def log_retry_error(retry_state):  
     logging.error(f"Retrying due to error: {retry_state.outcome.exception()}")  
 
+_wait_backoff = wait_random_exponential(min=1, max=60)
+
+def wait_retry_after(retry_state):
+    # the Retry-After delay of a throttling response if it has one, else random exponential backoff
+    error = retry_state.outcome.exception()
+    if isinstance(error, APIError) and error.retry_after is not None:
+        return error.retry_after
+    return _wait_backoff(retry_state)
+
+
+
+APPROXIMATE_TOKEN_COUNTER = "approximate (~4 characters per token)"
+
+_token_counters = {}
+_token_counters_lock = threading.Lock()
+
+def _approximate_num_tokens(text):
+    return len(text) // 4 + 1
+
+def _load_token_counter(model_type, model):
+    if model_type == "llama2":
+        # the model's own tokenizer (optional dependency), only if it is already in the local HF cache
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model, local_files_only=True)
+            return f"{model} tokenizer", lambda text: len(tokenizer.encode(text))
+        except Exception:
+            return APPROXIMATE_TOKEN_COUNTER, _approximate_num_tokens
+    # gpt tokenizer (optional dependency, see requirements.txt)
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return "tiktoken cl100k_base", lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return APPROXIMATE_TOKEN_COUNTER, _approximate_num_tokens
+
+def get_token_counter(model_type="gpt", model=None):
+    '''
+        return: (name, function counting the tokens of a text) of the tokenizer of a model
+            - gpt (and replay): tiktoken cl100k_base if installed
+            - llama2: the HF tokenizer of the model if transformers is installed and the tokenizer is cached locally
+        otherwise the count is approximate (~4 characters per token), named APPROXIMATE_TOKEN_COUNTER
+    '''
+    key = (model_type, model) if model_type == "llama2" else ("gpt", None)
+    with _token_counters_lock:
+        if key not in _token_counters:
+            _token_counters[key] = _load_token_counter(*key)
+        return _token_counters[key]
+
+def estimate_num_tokens(text):
+    # used for budgeting gpt requests before they are sent (see get_token_counter)
+    return get_token_counter()[1](text)
+
+def compute_gpt_cost(engine, prompt_tokens, completion_tokens):
+    # cost from the per-engine price table (USD per 1K tokens) in configs.py
+    if engine not in gpt_token_prices:
+        return 0 # TODO: add the price of other engines to gpt_token_prices
+    price = gpt_token_prices[engine]
+    return completion_tokens / 1000 * price["completion"] + prompt_tokens / 1000 * price["prompt"]
+
+
+class RateLimiter:
+    '''
+        token-bucket limiter on both requests-per-minute (rpm) and tokens-per-minute (tpm);
+        None means no limit. Thread-safe; `acquire` blocks until the request fits in both budgets, and returns the
+        tokens charged; `refund` settles them against the actual usage of the response.
+    '''
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = rpm
+        self.available_tokens = tpm
+        self.last_refill = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm:
+            self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, num_tokens):
+        # a single request larger than the whole budget waits for a full bucket
+        if self.tpm:
+            num_tokens = min(num_tokens, self.tpm)
+        with self.condition:
+            while True:
+                self._refill()
+                wait = 0
+                if self.rpm and self.available_requests < 1:
+                    wait = max(wait, (1 - self.available_requests) * 60 / self.rpm)
+                if self.tpm and self.available_tokens < num_tokens:
+                    wait = max(wait, (num_tokens - self.available_tokens) * 60 / self.tpm)
+                if wait == 0:
+                    if self.rpm:
+                        self.available_requests -= 1
+                    if self.tpm:
+                        self.available_tokens -= num_tokens
+                    return num_tokens
+                self.condition.wait(timeout=wait) # woken up early by refunds
+
+    def refund(self, num_tokens):
+        # charged tokens the response did not use; negative when it used more, which is then charged on top
+        # (the bucket can go below zero, later requests wait until it refills)
+        if self.tpm and num_tokens != 0:
+            with self.condition:
+                self._refill()
+                self.available_tokens = min(self.tpm, self.available_tokens + num_tokens)
+                if num_tokens > 0:
+                    self.condition.notify_all()
+
+
+# one limiter per engine (and endpoint), shared by every caller in the process
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(key, rpm=None, tpm=None):
+    # key: the engine (and endpoint) whose quota is shared
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(rpm=rpm, tpm=tpm)
+        return _rate_limiters[key]
+
+
+class ConcurrencyController:
+    '''
+        AIMD limit on the number of requests in flight to an endpoint, adapted to its throttling and latency.
+        Thread-safe; `run(fn, ...)` waits for a free slot, calls fn and updates the limit:
+            - increase: +1 per success while in slow start (doubles the limit every round trip), then +1/limit per
+              success (about +1 per round trip), up to max_limit
+            - decrease: the limit is multiplied by decrease_factor (and slow start ends) on a throttling response
+              (429 / 503), at most once per round trip (responses to requests sent before the last decrease are
+              ignored), or when the p90 latency of the last `window` responses exceeds latency_tolerance times the
+              lowest p90 seen since the last such decrease
+            - Retry-After: no new request is sent before the delay of a throttling response has passed
+    '''
+    THROTTLING_STATUS_CODES = (429, 503)
+
+    def __init__(self, max_limit, initial_limit=1, min_limit=1, decrease_factor=0.5, window=50, latency_tolerance=2.0):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = min(max(min_limit, 1), self.max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.slow_start = True
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latencies = deque(maxlen=window)
+        self.num_new_latencies = 0
+        self.min_p90 = None
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    self.num_requests += 1
+                    return time.monotonic()
+                self.condition.wait(timeout=wait if wait > 0 else None)
 
+    def _decrease(self):
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self.slow_start = False
+        self.last_decrease = time.monotonic()
+
+    def release(self, start_time, throttled=False, retry_after=None, failed=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.num_throttled += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                if start_time >= self.last_decrease:
+                    self._decrease()
+            elif not failed:
+                self.latencies.append(time.monotonic() - start_time)
+                self.num_new_latencies += 1
+                self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+                if self.num_new_latencies >= self.window:
+                    # latency check once per full window of new responses
+                    self.num_new_latencies = 0
+                    p90 = self._percentile(0.9)
+                    if self.min_p90 is None or p90 < self.min_p90:
+                        self.min_p90 = p90
+                    elif p90 > self.latency_tolerance * self.min_p90 and start_time >= self.last_decrease:
+                        self._decrease()
+                        self.min_p90 = p90 # new baseline, so that slower prompts (not load) only decrease the limit once
+            self.condition.notify_all()
+
+    def run(self, fn, *args, **kwargs):
+        start_time = self.acquire()
+        try:
+            res = fn(*args, **kwargs)
+        except APIError as e:
+            throttled = e.status_code in self.THROTTLING_STATUS_CODES
+            self.release(start_time, throttled=throttled, retry_after=e.retry_after, failed=not throttled)
+            raise
+        except BaseException:
+            self.release(start_time, failed=True)
+            raise
+        self.release(start_time)
+        return res
+
+    def _percentile(self, q):
+        latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] if latencies else None
+
+    def state(self):
+        with self.condition:
+            p50, p90 = self._percentile(0.5), self._percentile(0.9)
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "requests": self.num_requests,
+                "throttled": self.num_throttled,
+                "p50_latency": round(p50, 2) if p50 is not None else None,
+                "p90_latency": round(p90, 2) if p90 is not None else None,
+                "paused": max(0.0, round(self.paused_until - time.monotonic(), 1))
+            }
+
+
+# one controller per endpoint and engine, shared by every caller in the process
+_concurrency_controllers = {}
+
+def get_concurrency_controller(key, max_limit):
+    # the first caller sets max_limit
+    with _rate_limiters_lock:
+        if key not in _concurrency_controllers:
+            _concurrency_controllers[key] = ConcurrencyController(max_limit)
+        return _concurrency_controllers[key]
+
+
+class HedgePolicy:
+    '''
+        hedged requests: an attempt still running after the `percentile` latency of the recent attempts (once
+        min_samples latencies are known) gets a duplicate; the first one to succeed is used and the other one is
+        cancelled. Duplicates are capped at max_fraction of the attempts. Thread-safe
+    '''
+    def __init__(self, percentile=0.95, max_fraction=0.05, window=200, min_samples=20):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.num_attempts = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.lock = threading.Lock()
+
+    def get_delay(self):
+        # count a new attempt; return: the seconds after which it is hedged (None: not hedged)
+        with self.lock:
+            self.num_attempts += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+            return latencies[min(int(self.percentile * len(latencies)), len(latencies) - 1)]
+
+    def try_hedge(self):
+        # reserve a duplicate within the budget
+        with self.lock:
+            if self.num_hedges + 1 > self.max_fraction * self.num_attempts:
+                return False
+            self.num_hedges += 1
+            return True
+
+    def record(self, latency, hedge_won=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_hedge_wins += hedge_won
+
+    def state(self):
+        with self.lock:
+            return {"attempts": self.num_attempts, "hedged": self.num_hedges, "hedge_wins": self.num_hedge_wins}
+
+
+MAX_GENERATIONS_PER_CALL = 10 # gpt: max choices per api call; larger n is split into concurrent calls
 
 DEFAULT_GPT_CONFIG = {
     "engine": "devgpt4-32k",
@@ -35,37 +345,189 @@ DEFAULT_GPT_CONFIG = {
 }
 
 class OpenAIWrapper:
-    def __init__(self, config = DEFAULT_GPT_CONFIG, system_message=""):
-        # TODO: set up your API key with the environment variable OPENAIKEY
-        openai.api_key = os.environ.get("OPENAI_API_KEY")      
-
-        if os.environ.get("USE_AZURE")=="True":
+    '''
+        gpt backend (OpenAI / Azure OpenAI chat completions)
+            - api_key / api_base / api_type / api_version: endpoint of this wrapper (default: from the environment
+              variables, see config_template.sh); each wrapper owns its client, no api state is process-global
+            - pool_size: keep-alive connections of the client, i.e., max concurrent requests (e.g., --concurrency times
+              the number of calls per generation batch, see MAX_GENERATIONS_PER_CALL)
+            - request_timeout: socket timeout (in seconds) of each request
+            - adaptive_concurrency: adapt the number of requests in flight (up to pool_size) to the throttling and
+              latency of the endpoint, see ConcurrencyController
+            - hedge_percentile / hedge_max_fraction: duplicate the requests slower than this latency percentile, for at
+              most this fraction of the requests (see HedgePolicy; None: no hedging). Each raw response records whether
+              its request was hedged; duplicates are charged to the rate limiter like any other request
+    '''
+    def __init__(self, config = DEFAULT_GPT_CONFIG, system_message="", rate_limit=None, cache=None, stream=False,
+                 api_key=None, api_base=None, api_type=None, api_version=None, pool_size=10, request_timeout=600, adaptive_concurrency=False,
+                 hedge_percentile=None, hedge_max_fraction=0.05):
+        # TODO: set up your API key with the environment variable OPENAI_API_KEY
+        if api_type is None:
+            api_type = "azure" if os.environ.get("USE_AZURE") == "True" else "open_ai"
+        if api_type == "azure":
             print("using azure api")
-            openai.api_type = "azure"
-        openai.api_base = os.environ.get("API_BASE")
-        openai.api_version = os.environ.get("API_VERSION")
+        api_base = api_base or os.environ.get("API_BASE")
+        self.client = ChatCompletionsClient(
+            api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+            api_base=api_base,
+            api_type=api_type,
+            api_version=api_version or os.environ.get("API_VERSION"),
+            pool_size=pool_size * 2 if hedge_percentile is not None else pool_size, # room for the duplicates
+            timeout=request_timeout
+        )
 
         self.config = config
         print("api config:", config, '\n')
 
-        # count total tokens
+        # rate limiter (requests and tokens per minute), shared by all wrappers of the same engine and endpoint
+        if rate_limit is None:
+            rate_limit = {}
+        self.rate_limiter = get_rate_limiter((api_base, config["engine"]), rpm=rate_limit.get("rpm"), tpm=rate_limit.get("tpm"))
+
+        # optional adaptive limit on the requests in flight, shared by all wrappers of the same engine and endpoint
+        self.concurrency = get_concurrency_controller((api_base, config["engine"]), max_limit=pool_size) if adaptive_concurrency else None
+
+        # count total tokens (guarded by a lock, since instances may run concurrently)
         self.completion_tokens = 0
         self.prompt_tokens = 0
+        self.usage_lock = threading.Lock()
 
         # system message
         self.system_message = system_message # "You are an AI assistant that helps people find information."
 
+        # optional response cache (cache.ResponseCache)
+        self.cache = cache
+
+        # stream completions, so that they can be stopped as soon as the answer is complete
+        self.stream = stream
+
+        # the calls of a run with n > MAX_GENERATIONS_PER_CALL are sent concurrently (the first on the calling thread)
+        self.call_executor = ThreadPoolExecutor(max_workers=max(pool_size, 1))
+
+        # optional hedging of slow requests: attempts run on hedge_executor while the caller waits for the first result
+        self.hedge = HedgePolicy(percentile=hedge_percentile, max_fraction=hedge_max_fraction) if hedge_percentile is not None else None
+        # callers: the instance threads plus the call_executor threads (at most 2 * pool_size), two attempts each
+        self.hedge_executor = ThreadPoolExecutor(max_workers=4 * max(pool_size, 1)) if self.hedge is not None else None
+
     # retry using tenacity
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), retry_error_callback=log_retry_error)
+    @retry(wait=wait_retry_after, stop=stop_after_attempt(6), retry_error_callback=log_retry_error)
     def completions_with_backoff(self, **kwargs):
         # print("making api call:", kwargs)
         # print("====================================")
-        return openai.ChatCompletion.create(**kwargs)
+        return self._send(self.client.create, **kwargs)
+
+    @retry(wait=wait_retry_after, stop=stop_after_attempt(6), retry_error_callback=log_retry_error)
+    def stream_with_backoff(self, stop_predicate=None, **kwargs):
+        return self._send(self._stream_completion, stop_predicate=stop_predicate, **kwargs)
 
-    def run(self, prompt, n=1, system_message=""):
+    def _send(self, fn, **kwargs):
+        # one attempt of a request, hedged if enabled; every attempt (including the retries after 429s and errors)
+        # is charged to the rate limiter: the prompt tokens plus the max completion tokens of every choice, settled
+        # against the usage of the response (a failed attempt keeps its whole charge)
+        num_budget_tokens = self.rate_limiter.acquire(self._get_budget_tokens(kwargs["messages"], kwargs.get("n", 1)))
+        if self.hedge is None:
+            res = self._attempt(fn, **kwargs)
+        else:
+            res = self._send_hedged(fn, **kwargs)
+        self.rate_limiter.refund(num_budget_tokens - res["usage"]["prompt_tokens"] - res["usage"]["completion_tokens"])
+        return res
+
+    def _attempt(self, fn, **kwargs):
+        # through the concurrency controller if any
+        if self.concurrency is not None:
+            return self.concurrency.run(fn, **kwargs)
+        return fn(**kwargs)
+
+    def _send_hedged(self, fn, **kwargs):
+        # send a duplicate if the attempt is still running after the hedge delay; return the first success
+        delay = self.hedge.get_delay()
+        handles = [RequestHandle()]
+        start_times = []
+        started = threading.Event()
+        def first_attempt():
+            start_times.append(time.monotonic())
+            started.set()
+            return self._attempt(fn, handle=handles[0], **kwargs)
+        futures = {self.hedge_executor.submit(first_attempt): 0}
+        # the hedge delay and the recorded latency run from the start of the attempt, not from its submission
+        started.wait()
+        done, _ = wait(futures, timeout=delay)
+        if not done and self.hedge.try_hedge():
+            handles.append(RequestHandle())
+            futures[self.hedge_executor.submit(self._attempt_duplicate, fn, handle=handles[1], **kwargs)] = 1
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                k = futures[future]
+                for handle in handles[:k] + handles[k+1:]:
+                    handle.cancel()
+                # latency of the first attempt (a lower bound if it is the one cancelled)
+                self.hedge.record(time.monotonic() - start_times[0], hedge_won=k == 1)
+                res = future.result()
+                res["hedged"] = len(handles) > 1
+                return res
+        raise error
+
+    def _attempt_duplicate(self, fn, **kwargs):
+        # duplicates use quota too: charged to the rate limiter like the first attempt (see _send), and settled the
+        # same way (a cancelled duplicate keeps its whole charge, its usage is unknown)
+        num_budget_tokens = self.rate_limiter.acquire(self._get_budget_tokens(kwargs["messages"], kwargs.get("n", 1)))
+        res = self._attempt(fn, **kwargs)
+        self.rate_limiter.refund(num_budget_tokens - res["usage"]["prompt_tokens"] - res["usage"]["completion_tokens"])
+        return res
+
+    def _stream_completion(self, stop_predicate=None, handle=None, **kwargs):
+        '''
+            streamed chat completion, consumed incrementally; once stop_predicate(text) reports the text of a choice as complete
+            (the length to keep, or None), the rest of that choice is dropped, and once every choice is done the stream
+            is closed, which cancels the generation
+            return: the same format as a non-streamed response (usage estimated locally, since streams do not report it)
+        '''
+        n = kwargs.get("n", 1)
+        texts = [""] * n
+        finish_reasons = [None] * n
+        num_completion_tokens = [0] * n
+        res = {}
+        stream = self.client.create(stream=True, handle=handle, **kwargs)
+        try:
+            for chunk in stream:
+                # azure sends chunks without choices (e.g., a first one with only prompt_filter_results)
+                if not chunk.get("choices"):
+                    continue
+                if not res:
+                    res = {"id": chunk.get("id"), "object": "chat.completion", "created": chunk.get("created"), "model": chunk.get("model")}
+                for choice in chunk["choices"]:
+                    k = choice["index"]
+                    if finish_reasons[k] is not None:
+                        continue
+                    texts[k] += (choice.get("delta") or {}).get("content") or ""
+                    end = stop_predicate(texts[k]) if stop_predicate is not None else None
+                    if choice.get("finish_reason") is not None or end is not None:
+                        num_completion_tokens[k] = estimate_num_tokens(texts[k])
+                        finish_reasons[k] = choice.get("finish_reason") or "early_stop"
+                        texts[k] = texts[k][:end]
+                if all(finish_reason is not None for finish_reason in finish_reasons):
+                    break
+        finally:
+            stream.close()
+        for k in range(n):
+            if finish_reasons[k] is None: # stream ended without a finish reason
+                num_completion_tokens[k] = estimate_num_tokens(texts[k])
+        res["choices"] = [{"index": k, "finish_reason": finish_reasons[k], "message": {"role": "assistant", "content": texts[k]}} for k in range(n)]
+        prompt_tokens = sum(estimate_num_tokens(m["content"]) for m in kwargs["messages"])
+        res["usage"] = {"completion_tokens": sum(num_completion_tokens), "prompt_tokens": prompt_tokens, "total_tokens": sum(num_completion_tokens) + prompt_tokens}
+        return res
+
+    def run(self, prompt, n=1, system_message="", stop_predicate=None):
         """
             prompt: str
             n: int, total number of generations specified
+            stop_predicate: optional (see tasks.base.get_answer_line_stop), only used when streaming
         """
         try:
             # overload system message
@@ -83,65 +545,374 @@ class OpenAIWrapper:
                 messages = [
                     {"role":"user","content":prompt}
                 ]
+            # look up the response cache before calling the api
+            # the endpoint is part of the request: servers that serve the same engine name do not share cache entries
+            request = {"backend": "gpt", "endpoint": self.client.api_base, "messages": messages, "n": n, "config": self.config}
+            if self.stream and stop_predicate is not None:
+                request["early_stop"] = True # stopped responses are truncated
+            if self.cache is not None:
+                cached = self.cache.get(request)
+                if cached is not None:
+                    return cached["text_outputs"], cached["raw_responses"]
+            # split the generations into calls of at most MAX_GENERATIONS_PER_CALL choices, sent concurrently
+            counts = [min(n - start, MAX_GENERATIONS_PER_CALL) for start in range(0, n, MAX_GENERATIONS_PER_CALL)]
+            futures = [self.call_executor.submit(self._call, messages, cnt, prompt, sys_m, stop_predicate) for cnt in counts[1:]]
             text_outputs = []
             raw_responses = []
-            while n > 0:
-                cnt = min(n, 10) # number of generations per api call
-                n -= cnt
-                res = self.completions_with_backoff(messages=messages, n=cnt, **self.config)
+            failed = False
+            for k in range(len(counts)):
+                # the choices of the calls that succeeded are kept (in order) when another call fails; the caller
+                # sees fewer than n outputs (run.py marks such records "partial")
+                try:
+                    res = self._call(messages, counts[0], prompt, sys_m, stop_predicate) if k == 0 else futures[k - 1].result()
+                except Exception as e:
+                    print("an error occurred:", e)
+                    failed = True
+                    continue
                 text_outputs.extend([choice["message"]["content"] for choice in res["choices"]])
-                # add prompt to log
-                res['prompt'] = prompt
-                if sys_m != "":
-                    res['system_message'] = sys_m
                 raw_responses.append(res)
-                # log completion tokens
-                self.completion_tokens += res["usage"]["completion_tokens"]
-                self.prompt_tokens += res["usage"]["prompt_tokens"]
 
+            if self.cache is not None and not failed: # partial results are not cached
+                self.cache.put(request, {"text_outputs": text_outputs, "raw_responses": raw_responses})
             return text_outputs, raw_responses
         except Exception as e:
             print("an error occurred:", e)
             return [], []
 
-    def compute_gpt_usage(self):
-        engine = self.config["engine"]
-        if engine == "devgpt4-32k":
-            cost = self.completion_tokens / 1000 * 0.12 + self.prompt_tokens / 1000 * 0.06
+    def _get_budget_tokens(self, messages, cnt):
+        # tokens reserved for a call: its prompt tokens plus the max completion tokens of every choice
+        return sum(estimate_num_tokens(m["content"]) for m in messages) + cnt * (self.config.get("max_tokens") or 0)
+
+    def _call(self, messages, cnt, prompt, sys_m, stop_predicate=None):
+        # one api call of cnt choices (retried, each attempt is charged to the rate limiter); thread-safe
+        if self.stream:
+            res = self.stream_with_backoff(stop_predicate=stop_predicate, messages=messages, n=cnt, **self.config)
         else:
-            cost = 0 # TODO: add custom cost calculation for other engines
+            res = self.completions_with_backoff(messages=messages, n=cnt, **self.config)
+        if res is None: # every retry failed (see log_retry_error)
+            raise RuntimeError(f"no response after retries ({cnt} generations)")
+        # add prompt to log
+        res['prompt'] = prompt
+        if sys_m != "":
+            res['system_message'] = sys_m
+        # log completion tokens
+        with self.usage_lock:
+            self.completion_tokens += res["usage"]["completion_tokens"]
+            self.prompt_tokens += res["usage"]["prompt_tokens"]
+        return res
+
+    def close(self):
+        # stop the executor threads and close the pooled connections; the wrapper cannot be used afterwards
+        self.call_executor.shutdown(wait=True)
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=True) # cancelled duplicates stop as soon as their connection is shut down
+        self.client.close()
+
+    def compute_gpt_usage(self):
+        cost = compute_gpt_cost(self.config["engine"], self.prompt_tokens, self.completion_tokens)
         return {"completion_tokens": self.completion_tokens, "prompt_tokens": self.prompt_tokens, "cost": cost}
 
 
 DEFAULT_LLAMA2_CONFIG = {
     "task": "text-generation",
     "model": "meta-llama/Llama-2-7b-chat-hf",
-    "torch_dtype": torch.float16,
+    "torch_dtype": "float16",
     "device_map": "auto",
-    "do_sample": False
+    "do_sample": False,
+    "max_new_tokens": 1024
 }
 
+class StopPredicateCriteria:
+    '''
+        stopping criteria (same interface as transformers.StoppingCriteria) that runs the stop predicates (see tasks.base.get_answer_line_stop) of a batch while it is generated; generation
+        stops once every sequence either ended (eos) or completed its answer
+            - input_len: length of the (padded) prompts
+            - stops: stop predicate of each sequence (None to generate until eos / max_new_tokens)
+        num_tokens[row]: number of generated tokens when the answer of the sequence was completed (else None)
+    '''
+    def __init__(self, tokenizer, input_len, stops):
+        self.tokenizer = tokenizer
+        self.input_len = input_len
+        self.stops = stops
+        self.num_tokens = [None] * len(stops)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = True
+        for row, ids in enumerate(input_ids):
+            if self.num_tokens[row] is not None:
+                continue
+            new_ids = ids[self.input_len:].tolist()
+            if self.tokenizer.eos_token_id in new_ids:
+                continue
+            if self.stops[row] is not None and self.stops[row](self.tokenizer.decode(new_ids, skip_special_tokens=True)) is not None:
+                self.num_tokens[row] = len(new_ids)
+            else:
+                done = False
+        return done
+
+
 class Llama2Wrapper:
-    def __init__(self, config = DEFAULT_LLAMA2_CONFIG):
-        self.tokenizer = AutoTokenizer.from_pretrained(config["model"])
-        self.pipeline = transformers.pipeline(**config)
+    '''
+        local llama2 backend (transformers pipeline)
+            - batch_size: max number of prompts generated together; with batch_size > 1, concurrent `run` calls
+              (e.g., instances running with --concurrency) are collected into batches
+            - batch_wait: how long (in seconds) a batch waits for more requests before it is generated
+            - prefix_cache_size: max number of shared prompt prefixes whose key/value cache is kept (0 to disable)
+            - min_prefix_tokens: min length of a prefix shared with a recent prompt for it to be cached
+            - stream: check the stop predicate of each request while generating, and stop once the answer is complete
+    '''
+    def __init__(self, config = DEFAULT_LLAMA2_CONFIG, cache=None, batch_size=1, batch_wait=0.05, prefix_cache_size=0, min_prefix_tokens=256, stream=False):
+        _load_llama_backend()
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(config["model"])
+        self.pipeline = transformers.pipeline(**dict(config, torch_dtype=resolve_torch_dtype(config.get("torch_dtype", "auto"))))
         self.config = config
+        # optional response cache (cache.ResponseCache)
+        self.cache = cache
 
-    def run(self, prompt, n=1, system_message=""):
-        #TODO: make this configurable
-        sequences = self.pipeline(
-            prompt,
-            do_sample=self.config["do_sample"],
-            num_return_sequences=n,
-            eos_token_id=self.tokenizer.eos_token_id,
-            max_length=3999,
-        )
+        # batching: llama has no pad token; pad on the left since generation continues on the right
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait
+        if self.pipeline.tokenizer.pad_token is None:
+            self.pipeline.tokenizer.pad_token = self.pipeline.tokenizer.eos_token
+        self.pipeline.tokenizer.padding_side = "left"
+        self.pending = [] # (prompt, n, system_message, stop_predicate, future) waiting to be batched
+        self.pending_cond = threading.Condition()
+        self.batch_thread = None
+
+        # shared-prefix key/value cache: prefix token ids -> past_key_values (LRU)
+        self.prefix_cache_size = prefix_cache_size
+        self.min_prefix_tokens = min_prefix_tokens
+        self.prefix_cache = OrderedDict()
+        self.recent_prompts = deque(maxlen=8) # token ids of recent prompts, used to discover shared prefixes
+        self.prefix_lock = threading.Lock()
+
+        # generation budget and token counts
+        self.max_new_tokens = config.get("max_new_tokens", 1024)
+        self.completion_tokens = 0
+        self.prompt_tokens = 0
+        self.usage_lock = threading.Lock()
+
+        # early termination with the stop predicates of the requests
+        self.stream = stream
+
+    def run(self, prompt, n=1, system_message="", stop_predicate=None):
+        if self.batch_size == 1:
+            return self.run_batch([prompt], n=n, system_message=system_message, stop_predicates=[stop_predicate])[0]
+        # hand the request over to the batching thread and wait for its result
+        future = Future()
+        with self.pending_cond:
+            if self.batch_thread is None:
+                self.batch_thread = threading.Thread(target=self._batch_loop, daemon=True)
+                self.batch_thread.start()
+            self.pending.append((prompt, n, system_message, stop_predicate, future))
+            self.pending_cond.notify_all()
+        return future.result()
+
+    def _batch_loop(self):
+        while True:
+            with self.pending_cond:
+                while not self.pending:
+                    self.pending_cond.wait()
+                # give other instances a moment to join the batch
+                deadline = time.monotonic() + self.batch_wait
+                while len(self.pending) < self.batch_size and time.monotonic() < deadline:
+                    self.pending_cond.wait(deadline - time.monotonic())
+                requests, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            # requests with different n / system message cannot share a pipeline call
+            groups = {}
+            for request in requests:
+                groups.setdefault((request[1], request[2]), []).append(request)
+            for (n, system_message), group in groups.items():
+                try:
+                    results = self.run_batch([request[0] for request in group], n=n, system_message=system_message, stop_predicates=[request[3] for request in group])
+                except Exception as e:
+                    for request in group:
+                        request[4].set_exception(e)
+                    continue
+                for request, result in zip(group, results):
+                    request[4].set_result(result)
+
+    def run_batch(self, prompts, n=1, system_message="", stop_predicates=None):
+        '''
+            prompts: list of str
+            n: int, number of generations per prompt
+            stop_predicates: optional stop predicate of each prompt, only used when streaming
+            return: list of (text_outputs, raw_responses), in the order of prompts
+        '''
+        results = [None] * len(prompts)
+        stops = stop_predicates if stop_predicates is not None and self.stream else [None] * len(prompts)
+        # look up the response cache before running the model
+        requests = [{"backend": "llama2", "prompt": prompt, "system_message": system_message, "n": n, "config": self.config} for prompt in prompts]
+        for request, stop in zip(requests, stops):
+            if stop is not None:
+                request["early_stop"] = True # stopped responses are truncated
+        to_generate = []
+        for k, request in enumerate(requests):
+            cached = self.cache.get(request) if self.cache is not None else None
+            if cached is not None:
+                results[k] = (cached["text_outputs"], cached["raw_responses"])
+            else:
+                to_generate.append(k)
+
+        # bucket prompts of similar length into the same batch to minimize padding
+        prompt_lengths = {k: len(self.pipeline.tokenizer(prompts[k])["input_ids"]) for k in to_generate}
+        to_generate.sort(key=lambda k: prompt_lengths[k])
+        for b in range(0, len(to_generate), self.batch_size):
+            batch = to_generate[b:b + self.batch_size]
+            # single prompts can reuse the key/value cache of a shared prefix
+            gen_outputs = None
+            if len(batch) == 1 and self.prefix_cache_size > 0:
+                gen_outputs = self._generate_with_prefix_cache(prompts[batch[0]], n, stops[batch[0]])
+            if gen_outputs is not None:
+                batch_gen_outputs = [gen_outputs]
+            else:
+                batch_gen_outputs = self._generate([prompts[k] for k in batch], n, [stops[k] for k in batch])
+            for k, gen_outputs in zip(batch, batch_gen_outputs):
+                results[k] = self._to_gpt_response(prompts[k], prompt_lengths[k], gen_outputs, system_message)
+                if self.cache is not None:
+                    self.cache.put(requests[k], {"text_outputs": results[k][0], "raw_responses": results[k][1]})
+        return results
+
+    def _max_new_tokens(self, input_len):
+        # the generation budget does not shrink with the prompt, but has to fit in the context window
+        return max(min(self.max_new_tokens, self.pipeline.model.config.max_position_embeddings - input_len), 1)
+
+    def _decode_new_tokens(self, new_ids, stop=None, num_stop_tokens=None):
+        '''
+            new_ids: generated token ids (without the prompt) of one sequence
+            stop / num_stop_tokens: stop predicate of the sequence / number of tokens when it was stopped
+            return: (generated text up to the end of the answer, number of generated tokens up to and including eos)
+        '''
+        new_ids = new_ids.tolist()
+        eos_token_id = self.tokenizer.eos_token_id
+        num_tokens = new_ids.index(eos_token_id) + 1 if eos_token_id in new_ids else len(new_ids)
+        if num_stop_tokens is not None:
+            num_tokens = min(num_tokens, num_stop_tokens)
+        text = self.pipeline.tokenizer.decode(new_ids[:num_tokens], skip_special_tokens=True)
+        end = stop(text) if stop is not None else None
+        return text[:end], num_tokens
+
+    def _get_stopping_criteria(self, input_len, stops):
+        # stopping criteria of a batch (one stop predicate per sequence), None if no sequence has one
+        if all(stop is None for stop in stops):
+            return None
+        return StopPredicateCriteria(self.pipeline.tokenizer, input_len, stops)
+
+    def _decode_outputs(self, output_ids, input_len, stops, stopping_criteria):
+        num_stop_tokens = stopping_criteria.num_tokens if stopping_criteria is not None else [None] * len(stops)
+        return [self._decode_new_tokens(ids[input_len:], stop, num_tokens) for ids, stop, num_tokens in zip(output_ids, stops, num_stop_tokens)]
+
+    def _generate(self, prompts, n, stops=None):
+        '''
+            generate a (left-padded) batch of prompts, decoding only the newly generated tokens
+            stops: optional stop predicate of each prompt
+            return: list (in the order of prompts) of n (generated text, number of generated tokens)
+        '''
+        model = self.pipeline.model
+        inputs = self.pipeline.tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+        input_len = inputs["input_ids"].shape[1]
+        # sequences of the same prompt are consecutive
+        stops = [stop for stop in (stops or [None] * len(prompts)) for _ in range(n)]
+        stopping_criteria = self._get_stopping_criteria(input_len, stops)
+        with torch.no_grad():
+            output_ids = model.generate(
+                **inputs,
+                do_sample=self.config["do_sample"],
+                num_return_sequences=n,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.pipeline.tokenizer.pad_token_id,
+                max_new_tokens=self._max_new_tokens(input_len),
+                stopping_criteria=transformers.StoppingCriteriaList([stopping_criteria] if stopping_criteria is not None else []),
+            )
+        gen_outputs = self._decode_outputs(output_ids, input_len, stops, stopping_criteria)
+        return [gen_outputs[k * n:(k + 1) * n] for k in range(len(prompts))]
+
+    def _get_prefix_cache(self, input_ids):
+        '''
+            input_ids: list of prompt token ids
+            return: (prefix length, past_key_values) of the longest cached prefix of the prompt, or (0, None);
+            prefixes shared with recent prompts (e.g., instances of the same template, or the steps of a
+            self-refine chain, where each prompt extends the previous one) are added to the cache
+        '''
+        model = self.pipeline.model
+        with self.prefix_lock:
+            # longest cached prefix (at least one prompt token has to be left for generation)
+            prefix_len, past_key_values = 0, None
+            for prefix in self.prefix_cache:
+                if prefix_len < len(prefix) < len(input_ids) and tuple(input_ids[:len(prefix)]) == prefix:
+                    prefix_len, past_key_values = len(prefix), self.prefix_cache[prefix]
+            if past_key_values is not None:
+                self.prefix_cache.move_to_end(tuple(input_ids[:prefix_len]))
+            # longest prefix shared with a recent prompt
+            shared_len = 0
+            for recent in self.recent_prompts:
+                k = 0
+                max_k = min(len(recent), len(input_ids) - 1)
+                while k < max_k and recent[k] == input_ids[k]:
+                    k += 1
+                shared_len = max(shared_len, k)
+            self.recent_prompts.append(tuple(input_ids))
+        if shared_len - prefix_len < self.min_prefix_tokens:
+            return prefix_len, past_key_values
+
+        # extend the cached prefix (if any) to the shared prefix and cache it
+        with torch.no_grad():
+            past_key_values = model(
+                torch.tensor([input_ids[prefix_len:shared_len]], device=model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).past_key_values
+        with self.prefix_lock:
+            self.prefix_cache[tuple(input_ids[:shared_len])] = past_key_values
+            while len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+        return shared_len, past_key_values
+
+    def _generate_with_prefix_cache(self, prompt, n, stop=None):
+        '''
+            generate from the key/value cache of a shared prefix, only prefilling the rest of the prompt
+            stop: optional stop predicate of the prompt
+            return: list of n (generated text, number of generated tokens), or None if no prefix is cached for the prompt
+        '''
+        model = self.pipeline.model
+        input_ids = self.pipeline.tokenizer(prompt)["input_ids"]
+        prefix_len, past_key_values = self._get_prefix_cache(input_ids)
+        if past_key_values is None:
+            return None
+        with torch.no_grad():
+            # prefill the rest of the prompt except its last token, which generate() feeds itself
+            if len(input_ids) - 1 > prefix_len:
+                past_key_values = model(
+                    torch.tensor([input_ids[prefix_len:-1]], device=model.device),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                ).past_key_values
+            if n > 1:
+                past_key_values = tuple(tuple(t.repeat_interleave(n, dim=0) for t in layer) for layer in past_key_values)
+            stops = [stop] * n
+            stopping_criteria = self._get_stopping_criteria(len(input_ids), stops)
+            output_ids = model.generate(
+                input_ids=torch.tensor([input_ids], device=model.device),
+                attention_mask=torch.ones(1, len(input_ids), dtype=torch.long, device=model.device),
+                past_key_values=past_key_values,
+                do_sample=self.config["do_sample"],
+                num_return_sequences=n,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.pipeline.tokenizer.pad_token_id,
+                max_new_tokens=self._max_new_tokens(len(input_ids)),
+                stopping_criteria=transformers.StoppingCriteriaList([stopping_criteria] if stopping_criteria is not None else []),
+            )
+        return self._decode_outputs(output_ids, len(input_ids), stops, stopping_criteria)
+
+    def _to_gpt_response(self, prompt, num_prompt_tokens, gen_outputs, system_message):
         # convert generation output into the same format as GPT raw response
         text_outputs = []
         raw_responses = []
-        for seq in sequences:
-            # remove prompt from the generated text
-            gen_text = seq['generated_text'][len(prompt):]
+        # log tokens (the prompt is counted once for all its sequences, like a GPT call with n choices)
+        with self.usage_lock:
+            self.prompt_tokens += num_prompt_tokens
+            self.completion_tokens += sum([num_tokens for _, num_tokens in gen_outputs])
+        for gen_text, num_completion_tokens in gen_outputs:
             text_outputs.append(gen_text)
             mock_id = str(uuid.uuid4())
             mock_gpt_response_obj = {
@@ -159,7 +930,11 @@ class Llama2Wrapper:
                         }
                     }
                 ],
-                "usage": {},
+                "usage": {
+                    "completion_tokens": num_completion_tokens,
+                    "prompt_tokens": num_prompt_tokens,
+                    "total_tokens": num_completion_tokens + num_prompt_tokens
+                },
                 "prompt":prompt,
                 "system_message":system_message
             }
@@ -167,7 +942,79 @@ class Llama2Wrapper:
         return text_outputs, raw_responses
     
     def compute_gpt_usage(self):
-        return {}
+        # local model: no cost
+        return {"completion_tokens": self.completion_tokens, "prompt_tokens": self.prompt_tokens, "cost": 0}
+
+
+class ReplayWrapper:
+    '''
+        offline backend serving the responses recorded in existing log files (e.g., logs/<task>/<model>/*.jsonl),
+        indexed by prompt and system message; no network or model is needed
+            - log_dir: directory searched recursively for log files (any format, see log_utils.LOG_FORMATS)
+            - model: only index records produced by this model (the "model" field of the log record); None for all
+            - latency: simulated latency (in seconds) of each call
+    '''
+    def __init__(self, log_dir="logs", model=None, system_message="", latency=0.0):
+        self.log_dir = log_dir
+        self.model = model
+        self.system_message = system_message
+        self.latency = latency
+
+        # count total tokens (from the recorded usage)
+        self.completion_tokens = 0
+        self.prompt_tokens = 0
+        self.usage_lock = threading.Lock()
+
+        # index: (prompt, system message) -> recorded raw responses of one call
+        self.index = {}
+        log_files = find_log_files(log_dir)
+        for log_file in log_files:
+            for log in read_logs(log_file):
+                if model is not None and log.get("model") != model:
+                    continue
+                self._index_log(log)
+        print(f"replay: indexed {len(self.index)} recorded calls from {len(log_files)} log files under {log_dir}")
+
+    def _index_log(self, log):
+        # recorded calls are lists of raw responses, possibly nested (codenames / self-refine records)
+        for value in log.values():
+            if isinstance(value, dict):
+                self._index_log(value)
+            elif isinstance(value, list) and value and isinstance(value[0], dict) and "choices" in value[0] and "prompt" in value[0]:
+                key = (value[0]["prompt"], value[0].get("system_message", ""))
+                self.index.setdefault(key, value)
+
+    def run(self, prompt, n=1, system_message="", stop_predicate=None):
+        # stop_predicate: ignored, recorded responses are served as they are
+        if system_message != "":
+            sys_m = system_message
+        else:
+            sys_m = self.system_message
+        if self.latency > 0:
+            time.sleep(self.latency)
+        recorded = self.index.get((prompt, sys_m))
+        if recorded is None:
+            print("replay: no recorded response for the prompt")
+            return [], []
+        text_outputs = []
+        raw_responses = []
+        for res in recorded:
+            if len(text_outputs) >= n:
+                break
+            choices = res["choices"][:n - len(text_outputs)]
+            if len(choices) < len(res["choices"]):
+                res = dict(res, choices=choices)
+            text_outputs.extend([choice["message"]["content"] for choice in choices])
+            raw_responses.append(res)
+            # log recorded tokens
+            with self.usage_lock:
+                self.completion_tokens += res["usage"].get("completion_tokens", 0)
+                self.prompt_tokens += res["usage"].get("prompt_tokens", 0)
+        return text_outputs, raw_responses
+
+    def compute_gpt_usage(self):
+        # replayed responses: no api call, no cost
+        return {"completion_tokens": self.completion_tokens, "prompt_tokens": self.prompt_tokens, "cost": 0}
 
 
 if __name__ == "__main__":
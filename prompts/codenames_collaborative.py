@@ -1,3 +1,5 @@
+from prompts.registry import register_prompt
+
 standard_prompt_spymaster = '''Try to find a single word hint that can accurately represent and link the {n} given words: "{target_words}". The key is to select a hint that does not cause confusion with other words from the following list: {word_list}.
 
 Your output should be of the following format:
@@ -603,3 +605,24 @@ Now, identify the participants, provide their profiles, and collaboratively solv
 
 Task: Try to identify the {n} words best associated with the word "{hint_word}" from the following list: {word_list}. Your answer should be a comma-separated list of words.
 '''
+
+
+## prompt template registry: (task, method, role, phase) -> template ##
+register_prompt('codenames_collaborative', 'standard', standard_prompt_spymaster, role='spymaster')
+register_prompt('codenames_collaborative', 'cot', cot_prompt_spymaster, role='spymaster')
+register_prompt('codenames_collaborative', 'spp', spp_prompt_spymaster, role='spymaster')
+register_prompt('codenames_collaborative', 'spp_less_demo', spp_prompt_spymaster_less_demo, role='spymaster')
+register_prompt('codenames_collaborative', 'spp_fixed_persona', spp_prompt_spymaster_fixed_persona, role='spymaster')
+register_prompt('codenames_collaborative', 'spp_profile', spp_prompt_spymaster_profile, role='spymaster')
+register_prompt('codenames_collaborative', 'self_refine', standard_prompt_spymaster, role='spymaster', phase='init')
+register_prompt('codenames_collaborative', 'self_refine', self_refine_feedback_prompt, role='spymaster', phase='feedback')
+register_prompt('codenames_collaborative', 'self_refine', self_refine_refinement_prompt, role='spymaster', phase='refine')
+register_prompt('codenames_collaborative', 'standard', standard_prompt_guesser, role='guesser')
+register_prompt('codenames_collaborative', 'cot', cot_prompt_guesser, role='guesser')
+register_prompt('codenames_collaborative', 'spp', spp_prompt_guesser, role='guesser')
+register_prompt('codenames_collaborative', 'spp_less_demo', spp_prompt_guesser_less_demo, role='guesser')
+register_prompt('codenames_collaborative', 'spp_fixed_persona', spp_prompt_guesser_fixed_persona, role='guesser')
+register_prompt('codenames_collaborative', 'spp_profile', spp_prompt_guesser_profile, role='guesser')
+register_prompt('codenames_collaborative', 'self_refine', standard_prompt_guesser, role='guesser', phase='init')
+register_prompt('codenames_collaborative', 'self_refine', self_refine_feedback_prompt, role='guesser', phase='feedback')
+register_prompt('codenames_collaborative', 'self_refine', self_refine_refinement_prompt, role='guesser', phase='refine')
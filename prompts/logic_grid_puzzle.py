@@ -1,3 +1,5 @@
+from prompts.registry import register_prompt
+
 standard_prompt = '''{input}
 
 Your output should be of the following format:
@@ -305,4 +307,16 @@ Final answer: 6 * (1 + 1) + 12 = 24
 Now, identify the participants and collaboratively solve the following task step by step. Remember to provide the final solution with the following format "Final answer: The house number here.".
 
 Task: {input}
-'''
\ No newline at end of file
+'''
+
+
+## prompt template registry: (task, method, role, phase) -> template ##
+register_prompt('logic_grid_puzzle', 'standard', standard_prompt)
+register_prompt('logic_grid_puzzle', 'cot', cot_prompt)
+register_prompt('logic_grid_puzzle', 'spp', spp_prompt)
+register_prompt('logic_grid_puzzle', 'spp_less_demo', spp_prompt_less_demo)
+register_prompt('logic_grid_puzzle', 'spp_fixed_persona', spp_prompt_fixed_persona)
+register_prompt('logic_grid_puzzle', 'spp_profile', spp_prompt_profile)
+register_prompt('logic_grid_puzzle', 'self_refine', standard_prompt, phase='init')
+register_prompt('logic_grid_puzzle', 'self_refine', self_refine_feedback_prompt, phase='feedback')
+register_prompt('logic_grid_puzzle', 'self_refine', self_refine_refinement_prompt, phase='refine')
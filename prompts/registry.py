@@ -0,0 +1,87 @@
+import string
+import importlib
+
+
+class PromptTemplate:
+    '''
+        prompt template (str.format syntax) parsed once into its literal text segments and placeholders
+            - prefix / suffix: the immutable text before the first / after the last placeholder (e.g., the SPP demonstrations)
+            - fields: names of the placeholders, in order
+            - num_prefix_tokens: token count of the prefix, computed once
+        render(fields) joins the literal segments with the field values in one pass, without re-parsing the template
+    '''
+    def __init__(self, template):
+        self.template = template
+        self.literals = [] # text before each placeholder, then the text after the last one
+        self.fields = []
+        self.format_specs = []
+        literal_parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            # escaped braces ({{ / }}) split the text into consecutive field-less segments, merged here
+            literal_parts.append(literal)
+            if field is None:
+                continue
+            if conversion is not None or field == "" or not field.isidentifier():
+                raise ValueError(f"unsupported placeholder {{{field}}} in prompt template")
+            self.literals.append("".join(literal_parts))
+            literal_parts = []
+            self.fields.append(field)
+            self.format_specs.append(format_spec)
+        self.literals.append("".join(literal_parts)) # text after the last placeholder
+        self.prefix = self.literals[0]
+        self.suffix = self.literals[-1]
+        self._num_prefix_tokens = None
+
+    @property
+    def num_prefix_tokens(self):
+        if self._num_prefix_tokens is None:
+            from models import estimate_num_tokens # only needed for token counting
+            self._num_prefix_tokens = estimate_num_tokens(self.prefix)
+        return self._num_prefix_tokens
+
+    def render(self, fields):
+        '''
+            fields: mapping from placeholder names to values (other keys are ignored)
+            return: the same string as template.format(**fields)
+        '''
+        parts = [self.prefix]
+        for field, format_spec, literal in zip(self.fields, self.format_specs, self.literals[1:]):
+            value = fields[field]
+            parts.append(value if isinstance(value, str) and format_spec == "" else format(value, format_spec))
+            parts.append(literal)
+        return "".join(parts)
+
+
+# (task, method, role, phase) -> PromptTemplate; role / phase are None for tasks / methods without them
+PROMPT_TEMPLATES = {}
+
+# tasks whose prompt module registers templates (prompts/<task>.py)
+PROMPT_TASKS = ['trivia_creative_writing', 'logic_grid_puzzle', 'codenames_collaborative']
+
+def register_prompt(task, method, template, role=None, phase=None):
+    prompt_template = PromptTemplate(template)
+    # check the parsed template against str.format, with a distinct value per placeholder
+    fields = {field: f"<{field}>" for field in prompt_template.fields}
+    if prompt_template.render(fields) != template.format(**fields):
+        raise ValueError(f"prompt template of {(task, method, role, phase)} does not render like str.format")
+    PROMPT_TEMPLATES[(task, method, role, phase)] = prompt_template
+
+def get_prompt_template(task, method, role=None, phase=None):
+    key = (task, method, role, phase)
+    if key not in PROMPT_TEMPLATES:
+        role_info = f" for {role} role" if role is not None else ""
+        phase_info = f" (phase: {phase})" if phase is not None else ""
+        raise NotImplementedError(f"method {method} not implemented{role_info}{phase_info}")
+    return PROMPT_TEMPLATES[key]
+
+def get_prompt_prefixes(task, min_length=1):
+    # distinct template prefixes of a task (at least min_length characters), longest first
+    importlib.import_module(f"prompts.{task}")
+    prefixes = {template.prefix for key, template in PROMPT_TEMPLATES.items() if key[0] == task and len(template.prefix) >= min_length}
+    return sorted(prefixes, key=len, reverse=True)
+
+def get_prompt_methods():
+    # every method with a registered template, in registration order
+    for task in PROMPT_TASKS:
+        importlib.import_module(f"prompts.{task}")
+    return list(dict.fromkeys(method for _, method, _, _ in PROMPT_TEMPLATES))
@@ -1,3 +1,5 @@
+from prompts.registry import register_prompt
+
 standard_prompt = '''Write a short and coherent story about {topic} that incorporates the answers to the following {n} questions: {questions}
 '''
 
@@ -298,4 +300,16 @@ Final answer: 6 * (1 + 1) + 12 = 24
 Now, identify the participants and collaboratively solve the following task step by step. Remember to present your final solution with the prefix "Final answer:".
 
 Task: Write a short and coherent story about {topic} that incorporates the answers to the following {n} questions: {questions}
-'''
\ No newline at end of file
+'''
+
+
+## prompt template registry: (task, method, role, phase) -> template ##
+register_prompt('trivia_creative_writing', 'standard', standard_prompt)
+register_prompt('trivia_creative_writing', 'cot', cot_prompt)
+register_prompt('trivia_creative_writing', 'spp', spp_prompt)
+register_prompt('trivia_creative_writing', 'spp_less_demo', spp_prompt_less_demo)
+register_prompt('trivia_creative_writing', 'spp_fixed_persona', spp_prompt_fixed_persona)
+register_prompt('trivia_creative_writing', 'spp_profile', spp_prompt_profile)
+register_prompt('trivia_creative_writing', 'self_refine', standard_prompt, phase='init')
+register_prompt('trivia_creative_writing', 'self_refine', self_refine_feedback_prompt, phase='feedback')
+register_prompt('trivia_creative_writing', 'self_refine', self_refine_refinement_prompt, phase='refine')
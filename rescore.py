@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tasks import get_task
+from log_utils import CompactLogCodec, find_log_files, get_log_format, get_log_idx, read_log_lines, rewrite_log_lines
+
+
+# tasks loaded by each worker process; None when the task data file is not available
+_tasks = {}
+
+def _get_task(task_name, task_data_file):
+    if (task_name, task_data_file) not in _tasks:
+        try:
+            _tasks[(task_name, task_data_file)] = get_task(task_name, task_data_file)
+        except FileNotFoundError:
+            _tasks[(task_name, task_data_file)] = None
+    return _tasks[(task_name, task_data_file)]
+
+def _unwrap_raw_responses(task, raw_responses, method, **kwargs):
+    # the generations of a call, in the order returned by model.run, parsed with the current prompt_unwrap
+    unwrapped_outputs, success_flags = [], []
+    for res in raw_responses:
+        for choice in res["choices"]:
+            unwrapped_output, success_flag = task.prompt_unwrap(choice["message"]["content"], method, **kwargs)
+            unwrapped_outputs.append(unwrapped_output)
+            success_flags.append(success_flag)
+    return unwrapped_outputs, success_flags
+
+def _rescore_step(task, i, step, method, test_output=True, **kwargs):
+    # record of a single call (see run._get_response_default)
+    step["unwrapped_output"], step["parsing_success_flag"] = _unwrap_raw_responses(task, step["raw_response"], method, **kwargs)
+    step["test_output_infos"] = task.test_outputs(i, step["unwrapped_output"]) if test_output else []
+
+def _rescore_self_refine_chain(task, i, chain, method):
+    # answer_0 (init), feedback_j, answer_j+1 (refine) steps of a self-refine chain (see run._run_self_refine_default)
+    for key, step in chain.items():
+        if not isinstance(step, dict) or "raw_response" not in step:
+            continue
+        if key == "answer_0":
+            _rescore_step(task, i, step, method, phase="init")
+        elif key.startswith("answer_"):
+            _rescore_step(task, i, step, method, phase="refine")
+        elif key.startswith("feedback_"):
+            _rescore_step(task, i, step, method, test_output=False, phase="feedback")
+
+def rescore_record(log):
+    '''
+        re-apply the current prompt_unwrap and test_output of the task to the raw responses stored in a log record
+        (in place); the codenames hint word is kept: it is the one the guesser was prompted with
+        return: False if the record was left as it is (failed model call, or task data file not available)
+    '''
+    i = get_log_idx(log)
+    if i is None or "task" not in log:
+        return False
+    task = _get_task(log["task"], log["task_data_file"])
+    if task is None:
+        return False
+    method = log["method"]
+    if log["task"] == "codenames_collaborative":
+        if method == "self_refine":
+            final_answer = f"answer_{log['num_refine']}"
+            _rescore_self_refine_chain(task, i, log["spymaster_logs"], method)
+            _rescore_self_refine_chain(task, i, log["guesser_logs"], method)
+            log["parsing_success_flag_spymaster"] = log["spymaster_logs"][final_answer]["parsing_success_flag"]
+            log["parsing_success_flag_guesser"] = log["guesser_logs"][final_answer]["parsing_success_flag"]
+            if log["test_output_infos"]:
+                log["test_output_infos"] = task.test_outputs(i, log["guesser_logs"][final_answer]["unwrapped_output"][:1])
+        else:
+            log["spymaster_output"], log["parsing_success_flag_spymaster"] = _unwrap_raw_responses(task, log["raw_response_spymaster"], method)
+            log["guesser_output"], log["parsing_success_flag_guesser"] = _unwrap_raw_responses(task, log["raw_response_guesser"], method)
+            if log["test_output_infos"]:
+                log["test_output_infos"] = task.test_outputs(i, log["guesser_output"])
+    elif method == "self_refine":
+        _rescore_self_refine_chain(task, i, log, method)
+    else:
+        _rescore_step(task, i, log, method, test_output=bool(log["test_output_infos"]))
+    return True
+
+def _rescore_chunk(log_file, start, end):
+    '''
+        rescore the records in [start, end) bytes of a log file
+        return: (rescored lines, number of changed records, number of records left as they are)
+    '''
+    lines = []
+    num_changed, num_skipped = 0, 0
+    with open(log_file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start).decode("utf-8")
+    for line in data.splitlines(keepends=True):
+        if line.strip() == "":
+            continue
+        if not line.endswith("\n"):
+            line += "\n"
+        try:
+            log = json.loads(line)
+        except json.JSONDecodeError: # e.g., partially written last line
+            log = None
+        if log is None or not rescore_record(log):
+            num_skipped += 1
+            lines.append(line)
+            continue
+        new_line = json.dumps(log) + "\n"
+        if new_line != line:
+            num_changed += 1
+        lines.append(new_line)
+    return lines, num_changed, num_skipped
+
+def _rescore_compact_log(log_file, output_file):
+    '''
+        rescore a compressed (compact) log as a whole: records are decoded, rescored, then encoded again for the
+        output file (its prompt store gets the prompt prefixes)
+        return: (number of records, number of changed records, number of records left as they are)
+    '''
+    codec, lines = read_log_lines(log_file)
+    output_codec = CompactLogCodec(output_file, codec.config, codec.task) if codec is not None else None
+    new_lines = []
+    num_changed, num_skipped = 0, 0
+    for line in lines:
+        if line.strip() == "":
+            continue
+        if not line.endswith("\n"):
+            line += "\n"
+        try:
+            log = json.loads(line)
+        except json.JSONDecodeError: # e.g., partially written last line
+            num_skipped += 1
+            new_lines.append(line)
+            continue
+        if codec is not None:
+            log = codec.decode(log)
+        if not rescore_record(log):
+            num_skipped += 1
+        new_line = json.dumps(output_codec.encode(log) if output_codec is not None else log) + "\n"
+        if new_line != line:
+            num_changed += 1
+        new_lines.append(new_line)
+    rewrite_log_lines(output_file, new_lines, header=output_codec.header if output_codec is not None else None)
+    return len(new_lines), num_changed, num_skipped
+
+def _get_chunks(log_file, chunk_size):
+    # byte ranges of about chunk_size bytes, ending at line boundaries
+    size = os.path.getsize(log_file)
+    chunks = []
+    start = 0
+    with open(log_file, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline() # move to the end of the current line
+            end = min(f.tell(), size) if start + chunk_size < size else size
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def _get_log_files(paths):
+    log_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            log_files.extend(find_log_files(path))
+        else:
+            log_files.append(path)
+    return log_files
+
+def rescore(args):
+    log_files = _get_log_files(args['paths'])
+    print("num of log files:", len(log_files))
+    start_time = time.time()
+    # fan out by file and by chunk of records; the chunks of each file are written back in order
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args['num_workers'], mp_context=ctx) as executor:
+        output_files, futures = {}, {}
+        for log_file in log_files:
+            if args['in_place']:
+                output_files[log_file] = log_file
+            else:
+                output_files[log_file] = os.path.join(args['output_dir'], os.path.relpath(log_file))
+                os.makedirs(os.path.dirname(output_files[log_file]), exist_ok=True)
+            if get_log_format(log_file) == "jsonl":
+                futures[log_file] = [executor.submit(_rescore_chunk, log_file, start, end) for start, end in _get_chunks(log_file, args['chunk_size_mb'] * 1024 * 1024)]
+            else:
+                # compressed logs cannot be split by byte ranges: rescored and written by one worker
+                futures[log_file] = executor.submit(_rescore_compact_log, log_file, output_files[log_file])
+        total_records, total_changed, total_skipped = 0, 0, 0
+        for log_file in log_files:
+            if isinstance(futures[log_file], list):
+                lines, num_changed, num_skipped = [], 0, 0
+                for future in futures[log_file]:
+                    chunk_lines, chunk_changed, chunk_skipped = future.result()
+                    lines.extend(chunk_lines)
+                    num_changed += chunk_changed
+                    num_skipped += chunk_skipped
+                rewrite_log_lines(output_files[log_file], lines)
+                num_records = len(lines)
+            else:
+                num_records, num_changed, num_skipped = futures[log_file].result()
+            total_records += num_records
+            total_changed += num_changed
+            total_skipped += num_skipped
+            print(f"\t{log_file} | records: {num_records} | changed: {num_changed} | skipped: {num_skipped}")
+    print(f"done rescoring {total_records} records ({total_changed} changed, {total_skipped} skipped) in {time.time() - start_time:.1f}s")
+
+
+def parse_args():
+    args = argparse.ArgumentParser()
+    args.add_argument('paths', type=str, nargs='*', default=['logs']) # log files, or directories searched recursively for logs (any format)
+    args.add_argument('--output_dir', type=str, default='logs_rescored') # rescored logs are written here, under the same relative paths
+    args.add_argument('--in_place', action='store_true') # overwrite the log files instead
+    args.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args.add_argument('--chunk_size_mb', type=int, default=4) # records of a log file are rescored in chunks of about this size
+    args = args.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = vars(parse_args())
+    print("rescore args:", args)
+    rescore(args)
@@ -0,0 +1,285 @@
+import os
+import json
+import math
+import time
+import argparse
+import numpy as np
+from log_utils import find_log_files, read_logs, get_log_idx, is_completed_log
+
+
+GROUP_COLUMNS = ["task", "method", "engine", "system_message"]
+STRING_COLUMNS = ["log_file"] + GROUP_COLUMNS
+INT_COLUMNS = ["idx", "num_generations", "num_correct", "num_parsed", "num_parse_flags", "prompt_tokens", "completion_tokens"]
+FLOAT_COLUMNS = ["score_sum"]
+# npz cache: the string columns (few distinct values, repeated on every row) are stored as integer codes into
+# their distinct values, like the dictionary-encoded string columns of the parquet cache
+CODES_SUFFIX, CATEGORIES_SUFFIX = "__codes", "__categories"
+METRICS = ["accuracy", "parse_rate", "pass_at_k"]
+
+_pyarrow = None
+
+def _get_pyarrow():
+    # optional: the cache is stored as parquet when pyarrow is installed, as a numpy .npz otherwise
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            _pyarrow = pyarrow
+        except ImportError:
+            _pyarrow = False
+    return _pyarrow
+
+
+def get_score(info):
+    # score in [0, 1] of one generation, from the test_output info of each task
+    if "correct" in info: # logic grid puzzle
+        return float(info["correct"])
+    if "question_count" in info: # trivia creative writing
+        return info["correct_count"] / info["question_count"]
+    return info["matched_count"] / info["target_count"] # codenames
+
+def _get_usage(log):
+    # prompt / completion tokens of all the api calls of a record, including the nested self-refine steps
+    prompt_tokens, completion_tokens = 0, 0
+    for key, value in log.items():
+        if key.startswith("raw_response") and isinstance(value, list):
+            for res in value:
+                usage = res.get("usage") or {}
+                prompt_tokens += usage.get("prompt_tokens", 0)
+                completion_tokens += usage.get("completion_tokens", 0)
+        elif isinstance(value, dict):
+            step_prompt_tokens, step_completion_tokens = _get_usage(value)
+            prompt_tokens += step_prompt_tokens
+            completion_tokens += step_completion_tokens
+    return prompt_tokens, completion_tokens
+
+def _get_engine(log):
+    if log.get("gpt_config"):
+        return log["gpt_config"]["engine"] or log["model"]
+    if log.get("llama_config"):
+        return log["llama_config"]["model"]
+    return log["model"]
+
+def _get_system_message(log, log_file):
+    if "system_message" in log:
+        return "with" if log["system_message"] != "" else "without"
+    # older logs only record it in the output directory / file name
+    if "wo_sys_mes" in log_file or "without_sys_mes" in log_file:
+        return "without"
+    if "w_sys_mes" in log_file or "with_sys_mes" in log_file:
+        return "with"
+    return "unknown"
+
+def _extract_row(log, log_file):
+    if log.get("method") == "self_refine" and log.get("task") != "codenames_collaborative":
+        # scored on the final refined answer
+        step = log[f"answer_{log['num_refine']}"]
+    else:
+        step = log
+    if log.get("task") == "codenames_collaborative":
+        parse_flags = log["parsing_success_flag_guesser"]
+    else:
+        parse_flags = step["parsing_success_flag"]
+    scores = [get_score(info) for info in step["test_output_infos"]]
+    prompt_tokens, completion_tokens = _get_usage(log)
+    return {
+        "log_file": log_file,
+        "task": log["task"],
+        "method": log["method"],
+        "engine": _get_engine(log),
+        "system_message": _get_system_message(log, log_file),
+        "idx": int(get_log_idx(log)),
+        "num_generations": len(scores),
+        "num_correct": sum(score == 1 for score in scores),
+        "num_parsed": sum(bool(flag) for flag in parse_flags),
+        "num_parse_flags": len(parse_flags),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "score_sum": sum(scores)
+    }
+
+def extract_log_file(log_file):
+    '''
+        columns of the completed records of a log file (one row per record); failed and unfinished records are skipped
+    '''
+    rows = []
+    for log in read_logs(log_file):
+        if not is_completed_log(log, log.get("num_refine", 1)) or not log.get("test_output_infos", True):
+            continue
+        rows.append(_extract_row(log, log_file))
+    return _to_columns(rows)
+
+def _to_columns(rows):
+    columns = {}
+    for column in STRING_COLUMNS:
+        columns[column] = np.array([row[column] for row in rows], dtype=str)
+    for column in INT_COLUMNS:
+        columns[column] = np.array([row[column] for row in rows], dtype=np.int64)
+    for column in FLOAT_COLUMNS:
+        columns[column] = np.array([row[column] for row in rows], dtype=np.float64)
+    return columns
+
+def _pass_at_k(n, c, k):
+    # unbiased pass@k estimate of a record with n generations of which c are correct
+    if n - c < k:
+        return 1.0
+    return 1.0 - math.comb(n - c, k) / math.comb(n, k)
+
+
+class ResultsStore:
+    '''
+        columnar cache of the scores, parsing flags, usage and config of the records of every log under log_dir, for
+        aggregating results without loading the logs
+            - one row per completed record, see extract_log_file; kept in cache_path (.parquet with pyarrow, .npz otherwise)
+            - refresh() only re-extracts the log files whose size or mtime changed since they were cached
+        query(metric, k, group_by, **filters): metric per group (default: task x method x engine x system message)
+    '''
+    def __init__(self, log_dir="logs", cache_path=".cache/results"):
+        self.log_dir = log_dir
+        self.cache_path = cache_path + (".parquet" if _get_pyarrow() else ".npz")
+        self.manifest = {} # log file -> [size, mtime_ns] when extracted
+        self.columns = _to_columns([])
+        if os.path.exists(self.cache_path):
+            self._load()
+
+    def _load(self):
+        pyarrow = _get_pyarrow()
+        if pyarrow:
+            table = pyarrow.parquet.read_table(self.cache_path)
+            self.manifest = json.loads(table.schema.metadata[b"manifest"])
+            self.columns = {column: np.asarray(table.column(column).to_numpy(zero_copy_only=False)) for column in table.column_names}
+            for column in STRING_COLUMNS:
+                self.columns[column] = self.columns[column].astype(str)
+        else:
+            with np.load(self.cache_path, allow_pickle=False) as data:
+                self.manifest = json.loads(str(data["manifest"]))
+                self.columns = {}
+                for column in STRING_COLUMNS + INT_COLUMNS + FLOAT_COLUMNS:
+                    if column + CODES_SUFFIX in data.files:
+                        self.columns[column] = data[column + CATEGORIES_SUFFIX][data[column + CODES_SUFFIX]]
+                    else: # cache written before the string columns were encoded
+                        self.columns[column] = data[column]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = self.cache_path + f".tmp{os.getpid()}"
+        pyarrow = _get_pyarrow()
+        if pyarrow:
+            table = pyarrow.table(self.columns).replace_schema_metadata({"manifest": json.dumps(self.manifest)})
+            pyarrow.parquet.write_table(table, tmp_path)
+        else:
+            arrays = {}
+            for column, values in self.columns.items():
+                if column in STRING_COLUMNS:
+                    categories, codes = np.unique(values, return_inverse=True)
+                    arrays[column + CATEGORIES_SUFFIX] = categories
+                    arrays[column + CODES_SUFFIX] = codes.reshape(-1).astype(np.int32)
+                else:
+                    arrays[column] = values
+            with open(tmp_path, "wb") as f:
+                np.savez(f, manifest=np.array(json.dumps(self.manifest)), **arrays)
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh(self):
+        '''
+            return: the log files (re-)extracted
+        '''
+        stats = {}
+        for log_file in find_log_files(self.log_dir):
+            stat = os.stat(log_file)
+            stats[log_file] = [stat.st_size, stat.st_mtime_ns]
+        changed = [log_file for log_file, stat in stats.items() if self.manifest.get(log_file) != stat]
+        if not changed and len(stats) == len(self.manifest):
+            return []
+        # drop the rows of changed and deleted log files, then append the re-extracted ones
+        kept = [log_file for log_file in self.manifest if stats.get(log_file) == self.manifest[log_file]]
+        keep_mask = np.isin(self.columns["log_file"], kept)
+        tables = [{column: values[keep_mask] for column, values in self.columns.items()}]
+        tables.extend(extract_log_file(log_file) for log_file in changed)
+        self.columns = {column: np.concatenate([table[column] for table in tables]) for column in self.columns}
+        self.manifest = {log_file: stats[log_file] for log_file in kept + changed}
+        self._save()
+        return changed
+
+    def query(self, metric="accuracy", k=1, group_by=GROUP_COLUMNS, **filters):
+        '''
+            - metric: "accuracy" (mean score of the generations), "parse_rate" (fraction of successfully parsed
+              generations) or "pass_at_k" (mean over records of the unbiased pass@k, a generation passes with a
+              full score; records with fewer than k generations are left out)
+            - filters: column -> value, e.g., task="logic_grid_puzzle"
+            return: list of dicts with the group columns, the metric and the number of records, sorted by group
+        '''
+        if metric not in METRICS:
+            raise ValueError(f"metric {metric} not supported; please choose from {METRICS}")
+        mask = np.ones(len(self.columns["idx"]), dtype=bool)
+        for column, value in filters.items():
+            mask &= self.columns[column] == value
+        if metric == "pass_at_k":
+            mask &= self.columns["num_generations"] >= k
+        columns = {column: values[mask] for column, values in self.columns.items()}
+
+        # one integer code per group
+        group_values, codes = [], np.zeros(len(columns["idx"]), dtype=np.int64)
+        for column in group_by:
+            values, inverse = np.unique(columns[column], return_inverse=True)
+            group_values.append(values)
+            codes = codes * len(values) + inverse.reshape(-1)
+        group_codes, group_inverse = np.unique(codes, return_inverse=True)
+        group_inverse = group_inverse.reshape(-1)
+        num_groups = len(group_codes)
+
+        if metric == "accuracy":
+            numerator, denominator = columns["score_sum"], columns["num_generations"]
+        elif metric == "parse_rate":
+            numerator, denominator = columns["num_parsed"], columns["num_parse_flags"]
+        else:
+            n, c = columns["num_generations"], columns["num_correct"]
+            # few distinct (n, c) pairs: compute the estimate once per pair
+            pairs, pair_inverse = np.unique(np.stack([n, c], axis=1), axis=0, return_inverse=True)
+            pair_values = np.array([_pass_at_k(int(pair_n), int(pair_c), k) for pair_n, pair_c in pairs], dtype=np.float64)
+            numerator, denominator = pair_values[pair_inverse.reshape(-1)], np.ones(len(n), dtype=np.int64)
+        numerator_sums = np.bincount(group_inverse, weights=numerator, minlength=num_groups)
+        denominator_sums = np.bincount(group_inverse, weights=denominator, minlength=num_groups)
+        num_records = np.bincount(group_inverse, minlength=num_groups)
+
+        results = []
+        for group, code in enumerate(group_codes):
+            result = {}
+            for column, values in reversed(list(zip(group_by, group_values))):
+                code, value_idx = divmod(int(code), len(values))
+                result[column] = str(values[value_idx])
+            result = {column: result[column] for column in group_by}
+            result[metric] = numerator_sums[group] / denominator_sums[group] if denominator_sums[group] > 0 else float("nan")
+            result["num_records"] = int(num_records[group])
+            results.append(result)
+        return results
+
+
+def parse_args():
+    args = argparse.ArgumentParser()
+    args.add_argument('--log_dir', type=str, default='logs')
+    args.add_argument('--cache_path', type=str, default='.cache/results') # extension added by storage format
+    args.add_argument('--metric', type=str, choices=METRICS, default='accuracy')
+    args.add_argument('--k', type=int, default=1) # for pass_at_k
+    args.add_argument('--group_by', type=str, nargs='+', choices=STRING_COLUMNS, default=GROUP_COLUMNS)
+    args.add_argument('--task', type=str, default=None)
+    args.add_argument('--method', type=str, default=None)
+    args.add_argument('--engine', type=str, default=None)
+    args.add_argument('--system_message', type=str, choices=['with', 'without', 'unknown'], default=None)
+    args = args.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = vars(parse_args())
+    start_time = time.time()
+    store = ResultsStore(args['log_dir'], args['cache_path'])
+    changed = store.refresh()
+    refresh_time = time.time() - start_time
+    start_time = time.time()
+    filters = {column: args[column] for column in GROUP_COLUMNS if args[column] is not None}
+    results = store.query(args['metric'], k=args['k'], group_by=args['group_by'], **filters)
+    query_time = time.time() - start_time
+    for result in results:
+        print(" | ".join(f"{value:.4f}" if isinstance(value, float) else str(value) for value in result.values()))
+    print(f"{len(results)} groups | {len(changed)} log files (re-)extracted in {refresh_time:.2f}s | query: {query_time * 1000:.1f}ms")
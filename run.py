@@ -1,20 +1,17 @@
 import os
-import json
 import argparse
-from models import OpenAIWrapper, Llama2Wrapper
+from models import OpenAIWrapper, Llama2Wrapper, ReplayWrapper, estimate_num_tokens, MAX_GENERATIONS_PER_CALL
 from tasks import get_task
-import time
-from configs import gpt_configs, llama_configs, default_gpt_config, default_llama_config
+from prompts.registry import get_prompt_methods
+from cache import ResponseCache, CACHE_MODES
+from scheduler import StageScheduler
+from log_utils import JsonlLogWriter, LOG_FORMATS, get_log_codec, load_completed_logs, find_shard_log_files, rewrite_log_lines
+from dry_run import estimate_run
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from configs import gpt_configs, llama_configs, default_gpt_config, default_llama_config, gpt_rate_limits, default_gpt_rate_limit
 
 
-SLEEP_RATE = 10 # sleep between calls
-
-
-def output_log_jsonl(log_file, all_logs):
-    with open(log_file, "w") as f:
-        for log in all_logs:
-            f.write(json.dumps(log) + "\n")
-
 def _post_process_raw_response(task, raw_output_batch, method, **kwargs):
     unwrapped_output_batch = []
     if_success_batch = []
@@ -28,14 +25,14 @@ def _post_process_raw_response(task, raw_output_batch, method, **kwargs):
 ### default task runners ###
 
 def _get_response_default(model, task, i, method, num_generation, prompt, test_output=True, **kwargs):
-    raw_output_batch, raw_response_batch = model.run(prompt=prompt, n=num_generation)
+    raw_output_batch, raw_response_batch = model.run(prompt=prompt, n=num_generation, stop_predicate=task.get_stop_predicate(method, **kwargs))
     if raw_output_batch == [] or raw_response_batch == []: # handle exception
         return {}    
     # get parsed response, and the success flags (whether or not the parsing is success) (standard prompt always success)
     unwrapped_output_batch, if_success_batch = _post_process_raw_response(task, raw_output_batch, method, **kwargs)
     # compute automatic metric (different for each task), e.g., if the output contains all the answers
     if test_output:
-        test_output_infos = [task.test_output(i, output) for output in unwrapped_output_batch]
+        test_output_infos = task.test_outputs(i, unwrapped_output_batch)
     else:
         test_output_infos = []
     # log output
@@ -46,75 +43,123 @@ def _get_response_default(model, task, i, method, num_generation, prompt, test_o
         "parsing_success_flag": if_success_batch,
         "test_output_infos": test_output_infos
     }
+    if len(raw_output_batch) < num_generation: # some of the calls failed (see OpenAIWrapper.run); --resume reruns it
+        log_output["partial"] = True
     return log_output
 
-def _run_task_default(model, task, i, method, num_generation, sleep_rate=SLEEP_RATE, test_output=True):
+def _run_task_default(model, task, i, method, num_generation, test_output=True):
     # get prompt
     prompt = task.get_input_prompt(i, method=method)
     # get response and parsed output 
     return _get_response_default(model, task, i, method, num_generation, prompt, test_output=test_output)
 
-def _run_task_codenames(model, task, i, method, num_generation, sleep_rate=SLEEP_RATE, test_output=True):
+def _run_spymaster_codenames(model, task, i, method):
     # get spymaster hint word
     spymaster_prompt = task.get_input_prompt(i, method=method, role='spymaster')
-    raw_spymaster_output, raw_response_spymaster = model.run(prompt=spymaster_prompt, n=1)
+    raw_spymaster_output, raw_response_spymaster = model.run(prompt=spymaster_prompt, n=1, stop_predicate=task.get_stop_predicate(method, role='spymaster'))
     if raw_spymaster_output == [] or raw_response_spymaster == []: # handle exception
         return {}
     spymaster_output, if_success_batch_spymaster = _post_process_raw_response(task, raw_spymaster_output, method)
     hint_word = spymaster_output[0].replace(".", "").strip()
     print(f"\tidx: {i} | done spymaster, hint word: {hint_word}")
-    # sleep before calling guesser
-    time.sleep(sleep_rate)
+    return {
+        "raw_response_spymaster": raw_response_spymaster,
+        "spymaster_output": spymaster_output,
+        "hint_word": hint_word,
+        "parsing_success_flag_spymaster": if_success_batch_spymaster
+    }
+
+def _run_guesser_codenames(model, task, i, method, num_generation, spymaster_log, test_output=True):
     # get guesser result
-    guesser_prompt = task.get_input_prompt(i, method=method, role='guesser', hint_word=hint_word)
-    raw_guesser_output, raw_response_batch_guesser = model.run(prompt=guesser_prompt, n=num_generation)
+    guesser_prompt = task.get_input_prompt(i, method=method, role='guesser', hint_word=spymaster_log["hint_word"])
+    raw_guesser_output, raw_response_batch_guesser = model.run(prompt=guesser_prompt, n=num_generation, stop_predicate=task.get_stop_predicate(method, role='guesser'))
     if raw_guesser_output == [] or raw_response_batch_guesser == []: # handle exception
         return {}
     guesser_output_batch, if_success_batch_guesser = _post_process_raw_response(task, raw_guesser_output, method)
     # compute automatic metric (different for each task), e.g., if the output contains all the answers
     if test_output:
-        test_output_infos = [task.test_output(i, output) for output in guesser_output_batch]
+        test_output_infos = task.test_outputs(i, guesser_output_batch)
     else:
         test_output_infos = []
     # log output
     log_output = {
         "idx": i,
-        "raw_response_spymaster": raw_response_spymaster,
+        "raw_response_spymaster": spymaster_log["raw_response_spymaster"],
         "raw_response_guesser": raw_response_batch_guesser,
-        "spymaster_output": spymaster_output,
+        "spymaster_output": spymaster_log["spymaster_output"],
         "guesser_output": guesser_output_batch,
-        "hint_word": hint_word,
-        "parsing_success_flag_spymaster": if_success_batch_spymaster,
+        "hint_word": spymaster_log["hint_word"],
+        "parsing_success_flag_spymaster": spymaster_log["parsing_success_flag_spymaster"],
         "parsing_success_flag_guesser": if_success_batch_guesser,
         "test_output_infos": test_output_infos
     }
+    if len(raw_guesser_output) < num_generation: # some of the calls failed (see OpenAIWrapper.run); --resume reruns it
+        log_output["partial"] = True
     return log_output
 
+def _run_task_codenames(model, task, i, method, num_generation, test_output=True):
+    spymaster_log = _run_spymaster_codenames(model, task, i, method)
+    if spymaster_log == {}:
+        return {}
+    return _run_guesser_codenames(model, task, i, method, num_generation, spymaster_log, test_output=test_output)
+
 ##############################
 
 ### self_refine task runners ###
 
-def _run_self_refine_default(model, task, i, method, num_generation, sleep_rate=SLEEP_RATE, num_refine=1, **kwargs):
+CONTEXT_POLICIES = ['full', 'latest', 'window']
+
+def _get_context_prompt(question, history, latest_answer, context_policy="full", context_token_budget=None):
+    '''
+        build the self-refine context (the question_answer of the feedback/refine prompts)
+            - history: "\n" + A0, then the "feedback + revised answer" text added by each refinement round
+            - full: Q + the whole history (Q + A0 + F + A1 + ...)
+            - latest: Q + the latest answer only (its feedback is added by the refine prompt)
+            - window: Q + the most recent rounds that fit in context_token_budget tokens (at least the latest one)
+    '''
+    if context_policy == "full":
+        return question + "".join(history)
+    elif context_policy == "latest":
+        return question + "\n" + latest_answer
+    elif context_policy == "window":
+        num_tokens = estimate_num_tokens(question)
+        start = len(history)
+        while start > 0:
+            num_round_tokens = estimate_num_tokens(history[start-1])
+            if start < len(history) and num_tokens + num_round_tokens > context_token_budget:
+                break
+            num_tokens += num_round_tokens
+            start -= 1
+        return question + "".join(history[start:])
+    else:
+        raise NotImplementedError(f"context policy {context_policy} not implemented; please choose from {CONTEXT_POLICIES}")
+
+def _run_self_refine_default(model, task, i, method, num_generation, num_refine=1, context_policy="full", context_token_budget=None, **kwargs):
     print("\tidx:", i, "start self refine...")
     log_outputs = {}
+    prompt_tokens = {} # estimated number of prompt tokens of each step under the context policy
     ## get initial response
     init_prompt = task.get_input_prompt(i, method=method, phase="init", **kwargs)
     init_output = _get_response_default(model, task, i, method, num_generation=1, prompt=init_prompt, test_output=True, phase="init")
     if init_output == {}:
         return {}
     log_outputs["answer_0"] = init_output
+    prompt_tokens["answer_0"] = estimate_num_tokens(init_prompt)
+    log_outputs["context_prompt_tokens"] = prompt_tokens
 
-    time.sleep(sleep_rate)
-    context_prompt = init_output['raw_response'][0]['prompt'] + "\n" + init_output["raw_response"][0]['choices'][0]['message']['content'] # Q + A0
+    question = init_output['raw_response'][0]['prompt'] # Q
+    latest_answer = init_output["raw_response"][0]['choices'][0]['message']['content'] # A0
+    history = ["\n" + latest_answer]
     for j in range(num_refine):
         print("\t\tstep:", j)
+        context_prompt = _get_context_prompt(question, history, latest_answer, context_policy, context_token_budget) # Q + A0 (+ F + A1 + ...)
         # get feedback
         feedback_prompt = task.get_input_prompt(i, method=method, phase="feedback", question_answer=context_prompt, **kwargs)
         feedback_output = _get_response_default(model, task, i, method, num_generation=1, prompt=feedback_prompt, test_output=False, phase="feedback")
         if feedback_output == {}:
             return log_outputs
         log_outputs[f"feedback_{j}"] = feedback_output
-        time.sleep(sleep_rate)
+        prompt_tokens[f"feedback_{j}"] = estimate_num_tokens(feedback_prompt)
 
         # get refined response
         refine_prompt = task.get_input_prompt(i, method=method, phase="refine", question_answer=context_prompt, feedback=feedback_output["unwrapped_output"][0], **kwargs) # Q + A0 + F
@@ -122,24 +167,28 @@ def _run_self_refine_default(model, task, i, method, num_generation, sleep_rate=
         if refine_output == {}:
             return log_outputs
         log_outputs[f"answer_{j+1}"] = refine_output
-        time.sleep(sleep_rate)
+        prompt_tokens[f"answer_{j+1}"] = estimate_num_tokens(refine_prompt)
 
-        # update context
-        context_prompt = refine_prompt + refine_output["raw_response"][0]['choices'][0]['message']['content'] # Q + A0 + F + A1
+        # update history: the refine prompt starts with the context, the rest is this round's feedback
+        latest_answer = refine_output["raw_response"][0]['choices'][0]['message']['content']
+        history.append(refine_prompt[len(context_prompt):] + latest_answer) # F + A1
 
     return log_outputs
 
-def _run_self_refine_codenames(model, task, i, method, num_generation, sleep_rate=SLEEP_RATE, num_refine=1, test_output=True):
+def _run_self_refine_spymaster_codenames(model, task, i, method, num_generation, num_refine=1, **context_kwargs):
     # get spymaster hint word
-    spy_master_log_outputs = _run_self_refine_default(model, task, i, method, num_generation, sleep_rate, num_refine, role='spymaster')
+    spy_master_log_outputs = _run_self_refine_default(model, task, i, method, num_generation, num_refine, role='spymaster', **context_kwargs)
     if f"answer_{num_refine}" not in spy_master_log_outputs:
         return {}
     hint_word = spy_master_log_outputs[f"answer_{num_refine}"]["unwrapped_output"][0].replace(".", "").strip()
     print(f"\tidx: {i} | num_refine: {num_refine} | done spymaster, hint word: {hint_word}")
-    # sleep before calling guesser
-    time.sleep(sleep_rate)
+    return {"spymaster_logs": spy_master_log_outputs, "hint_word": hint_word}
+
+def _run_self_refine_guesser_codenames(model, task, i, method, num_generation, spymaster_log, num_refine=1, test_output=True, **context_kwargs):
+    spy_master_log_outputs = spymaster_log["spymaster_logs"]
+    hint_word = spymaster_log["hint_word"]
     # get guesser result
-    guesser_log_outputs = _run_self_refine_default(model, task, i, method, num_generation, sleep_rate, num_refine, role='guesser', hint_word=hint_word)
+    guesser_log_outputs = _run_self_refine_default(model, task, i, method, num_generation, num_refine, role='guesser', hint_word=hint_word, **context_kwargs)
     if f"answer_{num_refine}" not in guesser_log_outputs:
         return {}
     guesser_output = guesser_log_outputs[f"answer_{num_refine}"]["unwrapped_output"][0]
@@ -159,90 +208,269 @@ def _run_self_refine_codenames(model, task, i, method, num_generation, sleep_rat
         "test_output_infos": test_output_infos
     }
     return log_output
+
+def _run_self_refine_codenames(model, task, i, method, num_generation, num_refine=1, test_output=True, **context_kwargs):
+    spymaster_log = _run_self_refine_spymaster_codenames(model, task, i, method, num_generation, num_refine, **context_kwargs)
+    if spymaster_log == {}:
+        return {}
+    return _run_self_refine_guesser_codenames(model, task, i, method, num_generation, spymaster_log, num_refine, test_output=test_output, **context_kwargs)
 ##############################
 
 
 
-def _run_task(task_name, model, task, i, method, num_generation, sleep_rate=SLEEP_RATE, **kwargs):
+def _run_task(task_name, model, task, i, method, num_generation, args, **kwargs):
     if task_name in ['trivia_creative_writing', 'logic_grid_puzzle']:
         if method == "self_refine":
-            log_output = _run_self_refine_default(model, task, i, method, num_generation, sleep_rate, num_refine = kwargs['num_refine'])
+            log_output = _run_self_refine_default(model, task, i, method, num_generation, **kwargs)
         else:
-            log_output = _run_task_default(model, task, i, method, num_generation, sleep_rate)
+            log_output = _run_task_default(model, task, i, method, num_generation)
     elif task_name == 'codenames_collaborative':
         if method == "self_refine":
-            log_output = _run_self_refine_codenames(model, task, i, method, num_generation, sleep_rate, num_refine = kwargs['num_refine'])
+            log_output = _run_self_refine_codenames(model, task, i, method, num_generation, **kwargs)
         else:
-            log_output = _run_task_codenames(model, task, i, method, num_generation, sleep_rate)
+            log_output = _run_task_codenames(model, task, i, method, num_generation)
     else:
         raise NotImplementedError(f"task {task_name} not implemented; please choose from ['trivia_creative_writing', 'logic_grid_puzzle', 'codenames_collaborative']")
 
-    # log everything else that is related
-    if "llama_config" in args:
-        args["llama_config"]["torch_dtype"] = str(args["llama_config"]["torch_dtype"])
+    return _add_run_info(log_output, task, i, args)
+
+def _get_num_hedged_calls(log_output):
+    # number of calls of a record whose request was hedged (raw responses are nested in self-refine records)
+    if isinstance(log_output, dict):
+        if "choices" in log_output:
+            return int(log_output.get("hedged", False))
+        return sum(_get_num_hedged_calls(value) for value in log_output.values())
+    if isinstance(log_output, list):
+        return sum(_get_num_hedged_calls(value) for value in log_output)
+    return 0
+
+def _add_run_info(log_output, task, i, args):
+    if args.get('hedge_percentile') is not None:
+        log_output["hedged"] = _get_num_hedged_calls(log_output) > 0
+    # log everything else that is related (dtypes are already strings in llama_configs)
     log_output.update(args)
     log_output.update({"task_data":task.get_input(i)})
     return log_output
 
-def run(args):
-    # get configs
+def _get_context_kwargs(args):
+    # self-refine context policy of the run
+    return {"context_policy": args['context_policy'], "context_token_budget": args['context_token_budget']}
+
+def _get_codenames_stages(model, task, args):
+    # codenames instances as two dependent stages (spymaster -> guesser) for the StageScheduler
+    method, num_generation, num_refine = args['method'], args['num_generation'], args['num_refine']
+    if method == "self_refine":
+        context_kwargs = _get_context_kwargs(args)
+        spymaster_stage = lambda i, state: _run_self_refine_spymaster_codenames(model, task, i, method, num_generation, num_refine, **context_kwargs)
+        guesser_stage = lambda i, spymaster_log: _run_self_refine_guesser_codenames(model, task, i, method, num_generation, spymaster_log, num_refine, **context_kwargs)
+    else:
+        spymaster_stage = lambda i, state: _run_spymaster_codenames(model, task, i, method)
+        guesser_stage = lambda i, spymaster_log: _run_guesser_codenames(model, task, i, method, num_generation, spymaster_log)
+    return [spymaster_stage, guesser_stage]
+
+def _get_log_file(args):
     model_type = args['model_type']
     task_name = args['task']
     method = args['method']
     start_idx, end_idx = args['task_start_index'], args['task_end_index']
     task_data_file = args['task_data_file']
-    num_generation = args['num_generation']
-    
+    additional_output_note = args['additional_output_note']
+    system_message = args['system_message']
+
     output_dir = args['output_dir']
     if output_dir == "":
         output_dir = f"logs/{task_name}"
 
-    additional_output_note = args['additional_output_note']
-    system_message = args['system_message']
-    print(f"setting default system message: {system_message}")
-    
-    # setup model and output log file
     if model_type == 'gpt':
         model_config = args['gpt_config']
-        model = OpenAIWrapper(config=model_config, system_message=system_message)
-        # setup log file
         model_name_for_output = model_config['engine'].replace("/", "-")
         if system_message == "":
             log_file = os.path.join(output_dir, f"{task_data_file}__method-{method}_engine-{model_name_for_output}_temp-{model_config['temperature']}_topp-{model_config['top_p']}_start{start_idx}-end{end_idx}{additional_output_note}__without_sys_mes.jsonl")
         else:
             log_file = os.path.join(output_dir, f"{task_data_file}__method-{method}_engine-{model_name_for_output}_temp-{model_config['temperature']}_topp-{model_config['top_p']}_start{start_idx}-end{end_idx}{additional_output_note}__with_sys_mes.jsonl")
-        sleep_rate = SLEEP_RATE
 
     elif model_type == 'llama2':
         model_config = args['llama_config']
-        model = Llama2Wrapper(config=model_config)
-        # setup log file
         model_name_for_output = model_config['model'].replace("/", "-")
         log_file = os.path.join(output_dir, f"{task_data_file}__method-{method}_engine-{model_name_for_output}_start{start_idx}-end{end_idx}{additional_output_note}__without_sys_mes.jsonl")
-        sleep_rate = 0
 
+    elif model_type == 'replay':
+        # kept out of the recorded logs
+        if args['output_dir'] == "":
+            output_dir = f"logs/replay/{task_name}"
+        model_name_for_output = args['model'].replace("/", "-")
+        if system_message == "":
+            log_file = os.path.join(output_dir, f"{task_data_file}__method-{method}_engine-replay-{model_name_for_output}_start{start_idx}-end{end_idx}{additional_output_note}__without_sys_mes.jsonl")
+        else:
+            log_file = os.path.join(output_dir, f"{task_data_file}__method-{method}_engine-replay-{model_name_for_output}_start{start_idx}-end{end_idx}{additional_output_note}__with_sys_mes.jsonl")
+
+    return log_file + LOG_FORMATS[args['log_format']]
+
+def _setup_model(args, rate_limit=None):
+    model_type = args['model_type']
+    system_message = args['system_message']
+
+    # setup response cache
+    if args['cache_mode'] == 'bypass':
+        cache = None
+    else:
+        cache = ResponseCache(args['cache_path'], mode=args['cache_mode'], max_size_mb=args['cache_max_size_mb'])
+        print(f"response cache: {args['cache_path']} ({args['cache_mode']})")
+
+    if model_type == 'gpt':
+        model = OpenAIWrapper(config=args['gpt_config'], system_message=system_message, rate_limit=rate_limit, cache=cache, stream=args['stream'],
+                              pool_size=max(args['concurrency'], 1) * -(-args['num_generation'] // MAX_GENERATIONS_PER_CALL), request_timeout=args['request_timeout'],
+                              adaptive_concurrency=args['adaptive_concurrency'], hedge_percentile=args['hedge_percentile'], hedge_max_fraction=args['hedge_max_fraction'])
+        print("rate limit:", rate_limit)
+    elif model_type == 'llama2':
+        model = Llama2Wrapper(config=args['llama_config'], cache=cache, batch_size=args['batch_size'], prefix_cache_size=args['prefix_cache_size'], stream=args['stream'])
+    elif model_type == 'replay':
+        model = ReplayWrapper(log_dir=os.path.join(args['replay_dir'], args['task']), model=args['model'], system_message=system_message, latency=args['replay_latency'])
+    return model, cache
+
+def _close_model(model):
+    # release the threads and keep-alive connections of the gpt backend
+    if isinstance(model, OpenAIWrapper):
+        model.close()
+
+def _run_indices(args, model, cache, task, indices, log_file, mode="w", codec=None, header=None):
+    '''
+        run the given instances and append their records to log_file
+            - codec / header: of compact logs (see log_utils.CompactLogCodec)
+        return: {idx: serialized log line}
+    '''
+    concurrency = max(args['concurrency'], 1)
+    log_lines = {}
+    # dispatch up to `concurrency` instances (or codenames stages) at once; results are consumed in index order
+    if args['task'] == 'codenames_collaborative':
+        executor = StageScheduler(_get_codenames_stages(model, task, args), num_workers=concurrency, finalize=lambda i, log_output: _add_run_info(log_output, task, i, args))
+        submit = executor.submit
+    else:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        submit = lambda i: executor.submit(_run_task, args['task'], model, task, i, args['method'], args['num_generation'], args, num_refine = args['num_refine'], **_get_context_kwargs(args))
+    with executor, JsonlLogWriter(log_file, mode=mode, fsync_every=args['fsync_every'], codec=codec, header=header) as log_writer:
+        futures = [submit(i) for i in indices]
+        for i, future in zip(indices, futures):
+            log_output = future.result()
+            status = []
+            if cache is not None:
+                status += ["| cache:", cache.stats()]
+            if getattr(model, 'concurrency', None) is not None:
+                status += ["| concurrency:", model.concurrency.state()]
+            if getattr(model, 'hedge', None) is not None:
+                status += ["| hedge:", model.hedge.state()]
+            print("\tidx:", i, "done | usage so far:", model.compute_gpt_usage(), *status)
+            # append log at each iteration
+            log_lines[i] = log_writer.write(log_output)
+    return log_lines
+
+def _run_shard(args, indices, shard_log_file, rate_limit=None, codec=None):
+    # worker process: set up its own model and task, and write the records (uncompressed) to its own shard file
+    model, cache = _setup_model(args, rate_limit)
+    task = get_task(args['task'], file=args['task_data_file'])
+    try:
+        _run_indices(args, model, cache, task, indices, shard_log_file, codec=codec)
+    finally:
+        _close_model(model)
+    return model.compute_gpt_usage()
+
+def _read_shard_lines(shard, shard_log_file):
+    # a shard file holds one line per instance, in the order of the shard indices, up to where its worker stopped
+    if not os.path.exists(shard_log_file):
+        return {}
+    with open(shard_log_file, "r") as f:
+        lines = [line for line in f.readlines() if line.endswith("\n")] # skip a partially written last line
+    os.remove(shard_log_file)
+    return dict(zip(shard, lines))
+
+def _run_sharded(args, indices, log_file, num_workers, log_lines, codec=None, header=None):
+    '''
+        split the instances into contiguous shards, run each shard in its own process, then read back the shard
+        files (deleted afterwards) into log_lines ({idx: serialized log line}) and rewrite the log file in index order;
+        the records of the shards that completed are merged even if a worker fails, so --resume only reruns the rest
+    '''
+    shard_size = -(-len(indices) // num_workers)
+    shards = [indices[k:k + shard_size] for k in range(0, len(indices), shard_size)]
+    shard_log_files = [f"{log_file}.shard{k}" for k in range(len(shards))]
+    # each worker gets an equal share of the rate limit
+    rate_limit = args.get('rate_limit')
+    if rate_limit is not None:
+        rate_limit = {key: (value // len(shards) if value else value) for key, value in rate_limit.items()}
+
+    # spawn (instead of fork) so that each worker initializes its own backend (e.g., torch / cuda)
+    try:
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_run_shard, args, shard, shard_log_file, rate_limit, codec) for shard, shard_log_file in zip(shards, shard_log_files)]
+            usages = [future.result() for future in futures]
+    finally:
+        for shard, shard_log_file in zip(shards, shard_log_files):
+            log_lines.update(_read_shard_lines(shard, shard_log_file))
+        rewrite_log_lines(log_file, [log_lines[i] for i in sorted(log_lines)], header=header)
+
+    # combined usage summary
+    total_usage = {}
+    for usage in usages:
+        for key, value in usage.items():
+            total_usage[key] = total_usage.get(key, 0) + value
+    print("done all shards | total usage:", total_usage)
+
+def run(args):
+    # get configs
+    task_name = args['task']
+    method = args['method']
+    start_idx, end_idx = args['task_start_index'], args['task_end_index']
+    num_workers = max(args['num_workers'], 1)
+    print(f"setting default system message: {args['system_message']}")
+
+    # setup output log file
+    log_file = _get_log_file(args)
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    codec = get_log_codec(log_file, args)
+    header = codec.header if codec is not None else None
     
     # setup task
-    task = get_task(task_name, file=task_data_file)
+    task = get_task(task_name, file=args['task_data_file'])
     
-    all_logs = []
     print("start running ... log file:", log_file)
-    print("sleep rate:", sleep_rate)
 
     print()
     start = max(start_idx, 0)
     end = min(end_idx, len(task))
     print("total num of instances:", end - start)
     print("method:", method)
-    for i in range(start, end):
-        log_output = _run_task(task_name, model, task, i, method, num_generation, sleep_rate, num_refine = args['num_refine'])
-        all_logs.append(log_output)
-        print("\tidx:", i, "done | usage so far:", model.compute_gpt_usage())
-        # output log at each iteration
-        output_log_jsonl(log_file, all_logs)
-        # sleep
-        time.sleep(sleep_rate)
+    print("concurrency:", max(args['concurrency'], 1))
+    print("num of workers:", num_workers)
+
+    # resume: keep the completed records of an existing log (and of the shard files left behind by a sharded run
+    # that was killed before merging them) and only run the missing indices
+    indices = list(range(start, end))
+    log_lines = {}
+    shard_log_files = find_shard_log_files(log_file) if args['resume'] else []
+    if args['resume'] and (os.path.exists(log_file) or shard_log_files):
+        if os.path.exists(log_file):
+            log_lines = load_completed_logs(log_file, num_refine=args['num_refine'], codec=codec)
+        for shard_log_file in shard_log_files:
+            log_lines.update(load_completed_logs(shard_log_file, num_refine=args['num_refine'], codec=codec))
+        indices = [i for i in indices if i not in log_lines]
+        # drop failed / partially written records before appending to the file
+        rewrite_log_lines(log_file, [log_lines[i] for i in sorted(log_lines)], header=header)
+        for shard_log_file in shard_log_files:
+            os.remove(shard_log_file)
+        print("resuming ... num of completed instances:", len(log_lines), "| num of remaining instances:", len(indices))
+
+    if num_workers > 1 and len(indices) > 1:
+        # run shards in worker processes, then merge them into the log file in index order
+        _run_sharded(args, indices, log_file, num_workers, log_lines, codec=codec, header=header)
+    else:
+        model, cache = _setup_model(args, args.get('rate_limit'))
+        num_resumed = len(log_lines)
+        try:
+            log_lines.update(_run_indices(args, model, cache, task, indices, log_file, mode="a" if num_resumed else "w", codec=codec, header=header))
+        finally:
+            _close_model(model)
+        # merge resumed and newly completed records into index order
+        if num_resumed:
+            rewrite_log_lines(log_file, [log_lines[i] for i in sorted(log_lines)], header=header)
 
 
 def parse_args():
@@ -250,8 +478,8 @@ def parse_args():
     args = argparse.ArgumentParser()
     args.add_argument('--model', type=str, choices=model_choices, required=True)
     args.add_argument('--output_dir', type=str, required=False, default="")
-    args.add_argument('--model_type', type=str, choices=['gpt','llama2'], default='gpt')
-    args.add_argument('--method', type=str, choices=['standard','cot','spp','spp_profile', 'spp_fixed_persona', 'self_refine', 'spp_less_demo'], required=True)
+    args.add_argument('--model_type', type=str, choices=['gpt','llama2','replay'], default='gpt')
+    args.add_argument('--method', type=str, choices=get_prompt_methods(), required=True)
     args.add_argument('--task', type=str, choices=['trivia_creative_writing', 'logic_grid_puzzle', 'codenames_collaborative'], required=True)
     args.add_argument('--task_data_file', type=str, required=True)
     args.add_argument('--task_start_index', type=int, required=True)
@@ -262,6 +490,28 @@ def parse_args():
     args.add_argument('--top_p', type=float, default=1.0)
     args.add_argument('--system_message', type=str, default="")
     args.add_argument('--num_refine', type=int, default=1) # Perform how many iterations of the self-refinement
+    args.add_argument('--context_policy', type=str, choices=CONTEXT_POLICIES, default='full') # self-refine context: 'full' history, 'latest' answer + feedback, or a rolling 'window' of rounds
+    args.add_argument('--context_token_budget', type=int, default=4096) # self-refine: max estimated tokens of the 'window' context
+    args.add_argument('--concurrency', type=int, default=1) # max number of instances in flight at once
+    args.add_argument('--rpm', type=int, default=None) # overwrite the requests-per-minute limit of the gpt engine
+    args.add_argument('--tpm', type=int, default=None) # overwrite the tokens-per-minute limit of the gpt engine
+    args.add_argument('--fsync_every', type=int, default=1) # flush and fsync the log file every N instances
+    args.add_argument('--resume', action='store_true') # skip the instances already completed in an existing log file
+    args.add_argument('--log_format', type=str, choices=list(LOG_FORMATS.keys()), default='jsonl') # gzip / zstd: compact logs, see log_utils.CompactLogCodec (zstd needs the zstandard package)
+    args.add_argument('--cache_mode', type=str, choices=CACHE_MODES, default='bypass') # on-disk response cache: 'bypass' (off), 'read_only' or 'write_through'
+    args.add_argument('--cache_path', type=str, default='.cache/responses.sqlite')
+    args.add_argument('--cache_max_size_mb', type=int, default=1024) # evict least recently used responses beyond this size
+    args.add_argument('--replay_dir', type=str, default='logs') # recorded logs served by --model_type replay
+    args.add_argument('--replay_latency', type=float, default=0.0) # simulated latency (seconds) of each replayed call
+    args.add_argument('--num_workers', type=int, default=1) # split the instances across N worker processes
+    args.add_argument('--batch_size', type=int, default=1) # llama2: max number of concurrent instances generated in one batch
+    args.add_argument('--prefix_cache_size', type=int, default=0) # llama2: number of shared prompt prefixes whose key/value cache is reused (0 to disable)
+    args.add_argument('--request_timeout', type=float, default=600) # socket timeout (seconds) of each gpt request
+    args.add_argument('--hedge_percentile', type=float, default=None) # gpt: duplicate the requests slower than this latency percentile (e.g., 0.95)
+    args.add_argument('--hedge_max_fraction', type=float, default=0.05) # gpt: max fraction of the requests that are duplicated
+    args.add_argument('--adaptive_concurrency', action='store_true') # gpt: adapt the requests in flight (up to --concurrency instances' calls) to throttling and latency
+    args.add_argument('--stream', action='store_true') # stream generations and stop them once the answer is complete (codenames, logic grid puzzle)
+    args.add_argument('--dry_run', action='store_true') # only estimate the calls, tokens and worst-case cost of the run
     
     args = args.parse_args()
     return args
@@ -282,6 +532,13 @@ if __name__ == '__main__':
         # overwrite temperature and top_p
         args['gpt_config']['temperature'] = args['temperature']
         args['gpt_config']['top_p'] = args['top_p']
+
+        # rate limit (requests and tokens per minute)
+        args['rate_limit'] = dict(gpt_rate_limits.get(model_name, default_gpt_rate_limit))
+        if args['rpm'] is not None:
+            args['rate_limit']['rpm'] = args['rpm']
+        if args['tpm'] is not None:
+            args['rate_limit']['tpm'] = args['tpm']
     
     elif model_type == 'llama2':
         ### llama config ###
@@ -292,4 +549,7 @@ if __name__ == '__main__':
             args['llama_config']['model'] = model_name
 
     print("run args:", args)
-    run(args)
\ No newline at end of file
+    if args['dry_run']:
+        print("dry run estimate (worst case):", estimate_run(args))
+    else:
+        run(args)
\ No newline at end of file
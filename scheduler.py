@@ -0,0 +1,67 @@
+import itertools
+import threading
+from queue import PriorityQueue
+from concurrent.futures import Future
+
+
+class StageScheduler:
+    '''
+        stage-aware scheduler for instances made of dependent stages (e.g., codenames: spymaster -> guesser)
+            - stages: list of functions stage(i, state) -> state; the first stage gets state None, the output of the
+              last stage is the result of the instance; a stage returning {} ends the instance with result {}
+            - num_workers: number of stages running at once
+            - finalize: optional function finalize(i, result) -> result applied to the result of every instance
+        pending later stages of started instances run before the first stage of new instances (and lower indices
+        first), so that while the first stages of upcoming instances keep the workers busy, started instances
+        finish (and can be logged) as early as possible
+    '''
+    def __init__(self, stages, num_workers=1, finalize=None):
+        self.stages = stages
+        self.finalize = finalize
+        self.queue = PriorityQueue()
+        self.counter = itertools.count() # tie breaker, keeps the queue from comparing states
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(num_workers, 1))]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, i):
+        future = Future()
+        self._put(0, i, None, future)
+        return future
+
+    def _put(self, stage_idx, i, state, future):
+        self.queue.put((-stage_idx, i, next(self.counter), stage_idx, state, future))
+
+    def _worker(self):
+        while True:
+            _, i, _, stage_idx, state, future = self.queue.get()
+            if future is None: # shutdown
+                return
+            try:
+                state = self.stages[stage_idx](i, state)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if state == {} or stage_idx == len(self.stages) - 1:
+                try:
+                    if self.finalize is not None:
+                        state = self.finalize(i, state)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                future.set_result(state)
+            else:
+                self._put(stage_idx + 1, i, state, future)
+
+    def shutdown(self):
+        # sentinels sort after every pending stage
+        for _ in self.workers:
+            self.queue.put((1, float("inf"), next(self.counter), None, None, None))
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,64 @@
+'''
+    startup time of the entry points (run from the repo root: python scripts/benchmark_startup.py)
+    backend dependencies are only imported when a backend is instantiated (see models._load_llama_backend; the gpt
+    backend only needs the standard library, see api_client.py); exits with status 1 if an entry point imports one at startup, or takes longer than
+    --max_seconds to start
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKEND_MODULES = ["torch", "transformers", "openai"]
+
+# entry point -> python code run at startup
+ENTRY_POINTS = {
+    "python -c pass": "pass", # interpreter startup, for reference
+    "import run": "import run",
+    "import models": "import models",
+    "import dry_run": "import dry_run",
+    "import rescore": "import rescore",
+    "import results": "import results",
+    "run.py --help": "import sys, runpy\nsys.argv = ['run.py', '--help']\ntry:\n    runpy.run_path('run.py', run_name='__main__')\nexcept SystemExit:\n    pass",
+}
+
+REPORT_CODE = "\nimport sys, json; print(json.dumps([m for m in {modules} if m in sys.modules]))"
+
+def measure(code, repeat):
+    # min wall time of a fresh interpreter running the code, and the backend modules it imported
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        start_time = time.time()
+        result = subprocess.run([sys.executable, "-c", code + REPORT_CODE.format(modules=BACKEND_MODULES)], cwd=ROOT_DIR, capture_output=True, text=True)
+        times.append(time.time() - start_time)
+        if result.returncode != 0:
+            raise RuntimeError(f"{code!r} failed:\n{result.stderr}")
+        lines = result.stdout.strip().splitlines()
+        if lines and lines[-1].startswith("["):
+            loaded = json.loads(lines[-1])
+    return min(times), loaded
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--repeat', type=int, default=5)
+    args.add_argument('--max_seconds', type=float, default=2.0)
+    args = vars(args.parse_args())
+
+    failed = False
+    for name, code in ENTRY_POINTS.items():
+        seconds, loaded = measure(code, args['repeat'])
+        status = "ok"
+        if loaded:
+            status = f"FAIL: imports {', '.join(loaded)} at startup"
+        elif seconds > args['max_seconds']:
+            status = f"FAIL: slower than {args['max_seconds']}s"
+        failed = failed or status != "ok"
+        print(f"{name:<20} {seconds * 1000:8.1f}ms | {status}")
+    sys.exit(1 if failed else 0)
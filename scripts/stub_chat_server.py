@@ -0,0 +1,161 @@
+'''
+    local stub of the chat completions api (OpenAI and Azure urls), for testing the gpt backend without an api key:
+        python scripts/stub_chat_server.py --port 8000 --latency 0.5
+        API_BASE=http://127.0.0.1:8000/v1 OPENAI_API_KEY=stub python run.py --model gpt4-32k ...
+    every choice answers "Answer: 1"; GET /stats reports the requests, connections and throttled requests served
+    StubChatServer can also be started from python (port 0 picks a free port, see .url)
+'''
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+STUB_CONTENT = "Let me think step by step.\nAnswer: 1\n\nThat is the final answer, explained at length."
+
+class StubChatServer(ThreadingHTTPServer):
+    '''
+        - latency: seconds before each response (streamed responses spread it over their chunks)
+        - slow_rate / slow_factor: fraction of the requests that are slow (stragglers), and how much slower
+        - max_in_flight: concurrent requests beyond this are throttled (429 with a Retry-After of retry_after seconds)
+        - throttle_rate: fraction of the other requests throttled at random
+        - throttle_first: number of requests throttled first (e.g., to test retries)
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, slow_rate=0.0, slow_factor=10.0, max_in_flight=None, throttle_rate=0.0, throttle_first=0, retry_after=1.0, seed=0):
+        super().__init__(("127.0.0.1", port), StubChatHandler)
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.max_in_flight = max_in_flight
+        self.throttle_rate = throttle_rate
+        self.throttle_first = throttle_first
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "connections": 0, "throttled": 0, "in_flight": 0, "max_in_flight": 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            stats = dict(self.server.stats)
+        self._send_json(200, stats)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            throttled = (server.stats["requests"] <= server.throttle_first
+                         or (server.max_in_flight is not None and server.stats["in_flight"] >= server.max_in_flight)
+                         or server.random.random() < server.throttle_rate)
+            slow = server.random.random() < server.slow_rate
+            if throttled:
+                server.stats["throttled"] += 1
+            else:
+                server.stats["in_flight"] += 1
+                server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.stats["in_flight"])
+        if throttled:
+            self._send_json(429, {"error": {"code": "429", "message": "Requests to the stub are throttled."}}, {"Retry-After": str(server.retry_after)})
+            return
+        try:
+            latency = server.latency * (server.slow_factor if slow else 1)
+            if request.get("stream"):
+                self._stream(request, latency)
+            else:
+                time.sleep(latency)
+                self._send_json(200, self._get_response(request))
+        except (BrokenPipeError, ConnectionResetError): # the client cancelled the request
+            self.close_connection = True
+        finally:
+            with server.lock:
+                server.stats["in_flight"] -= 1
+
+    def _get_response(self, request):
+        n = request.get("n", 1)
+        prompt_tokens = sum(len(m["content"]) // 4 + 1 for m in request["messages"])
+        completion_tokens = len(STUB_CONTENT) // 4 + 1
+        return {
+            "id": f"chatcmpl-stub-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": k, "finish_reason": "stop", "message": {"role": "assistant", "content": STUB_CONTENT}} for k in range(n)],
+            "usage": {"completion_tokens": n * completion_tokens, "prompt_tokens": prompt_tokens, "total_tokens": n * completion_tokens + prompt_tokens}
+        }
+
+    def _stream(self, request, latency):
+        n = request.get("n", 1)
+        words = STUB_CONTENT.split(" ")
+        chunk_id = f"chatcmpl-stub-{uuid.uuid4().hex}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, word in enumerate(words):
+            time.sleep(latency / len(words))
+            last = i == len(words) - 1
+            choices = [{"index": k, "delta": {"content": word + ("" if last else " ")}, "finish_reason": "stop" if last else None} for k in range(n)]
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "stub"), "choices": choices}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--port', type=int, default=8000)
+    args.add_argument('--latency', type=float, default=0.0)
+    args.add_argument('--slow_rate', type=float, default=0.0)
+    args.add_argument('--slow_factor', type=float, default=10.0)
+    args.add_argument('--max_in_flight', type=int, default=None)
+    args.add_argument('--throttle_rate', type=float, default=0.0)
+    args.add_argument('--throttle_first', type=int, default=0)
+    args.add_argument('--retry_after', type=float, default=1.0)
+    args = vars(args.parse_args())
+    server = StubChatServer(**args)
+    print("stub chat completions api at", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
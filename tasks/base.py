@@ -1,14 +1,51 @@
+import re
+import functools
+from prompts.registry import get_prompt_template
+
 DATA_PATH = './data'
 
+def get_answer_line_stop(marker):
+    '''
+        stop predicate for streamed generations (see models.OpenAIWrapper.run) whose answer is the line after `marker`
+        (e.g., "Answer:"): returns the length of the text up to the end of the answer line once it is complete, else None
+    '''
+    pattern = re.compile(re.escape(marker) + r"\s*\S[^\n]*\n")
+    def stop(text):
+        match = pattern.search(text)
+        return match.end() if match is not None else None
+    return stop
+
 class Task:
+    name = None # key of the task in the prompt template registry (prompts/registry.py)
+
     def __init__(self):
-        pass
+        # per-instance prompt fields and answer matchers are computed once
+        self._cached_prompt_fields = functools.lru_cache(maxsize=1024)(self.get_prompt_fields)
+        self._cached_answer_matcher = functools.lru_cache(maxsize=1024)(self.get_answer_matcher)
 
     def __len__(self) -> int:
         pass
 
-    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+    def get_prompt_fields(self, idx: int) -> dict:
+        # values of the prompt template placeholders that come from the instance (e.g., the joined question list)
+        pass
+
+    def get_answer_matcher(self, idx: int):
+        # tasks scored by substring matching: the prepared patterns (tasks.scoring.SubstringMatcher) of the instance
         pass
 
+    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+        # kwargs: role / phase select the template, and fill the placeholders not given by the instance (e.g., hint_word)
+        template = get_prompt_template(self.name, method, role=kwargs.get("role"), phase=kwargs.get("phase"))
+        return template.render(dict(self._cached_prompt_fields(idx), **kwargs))
+
     def test_output(self, idx: int, output: str):
-        pass
\ No newline at end of file
+        pass
+
+    def test_outputs(self, idx: int, outputs: list):
+        # score several outputs of the same instance (e.g., num_generation > 1, or re-scoring logs)
+        return [self.test_output(idx, output) for output in outputs]
+
+    def get_stop_predicate(self, method: str, **kwargs):
+        # stop predicate ending a streamed generation once its answer is complete; None to generate the whole response
+        return None
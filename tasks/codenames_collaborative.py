@@ -1,15 +1,16 @@
 import os
 import re
-from tasks.base import Task, DATA_PATH
+from tasks.base import Task, DATA_PATH, get_answer_line_stop
 from prompts.codenames_collaborative import *
-import json
+from tasks.dataset import JsonlDataset
 
 class CodenamesCollaborativeTask(Task):
+    name = 'codenames_collaborative'
+
     def __init__(self, file='codenames_50.jsonl'):
         super().__init__()
         path = os.path.join(DATA_PATH, 'codenames_collaborative', file)
-        with open(path, "r") as f:
-            self.data = [json.loads(line) for line in f]
+        self.data = JsonlDataset(path)
 
     def __len__(self) -> int:
         return len(self.data)
@@ -17,72 +18,17 @@ class CodenamesCollaborativeTask(Task):
     def get_input(self, idx: int):
         return self.data[idx]
 
-    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+    def get_prompt_fields(self, idx: int) -> dict:
         datapoint = self.data[idx]
-        word_list = datapoint['word_list']
-        word_list_str = ", ".join(word_list)
         target_words = datapoint['target_words']
-        target_words_str = ", ".join(target_words)
+        return {"n": len(target_words), "target_words": ", ".join(target_words), "word_list": ", ".join(datapoint['word_list'])}
 
-        # for guesser
+    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+        # the role selects the template; the guesser also needs the hint word
         assert 'role' in kwargs
-        role = kwargs['role']
-        if role == 'guesser':
+        if kwargs['role'] == 'guesser':
             assert 'hint_word' in kwargs
-            hint_word = kwargs['hint_word']
-        else:
-            hint_word = None
-
-        n = len(target_words)
-        if role == 'spymaster':
-            if method == "standard":
-                input_prompt = standard_prompt_spymaster.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "cot":
-                input_prompt = cot_prompt_spymaster.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "spp":
-                input_prompt = spp_prompt_spymaster.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "spp_less_demo":
-                input_prompt = spp_prompt_spymaster_less_demo.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "spp_fixed_persona":
-                input_prompt = spp_prompt_spymaster_fixed_persona.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "spp_profile":
-                input_prompt = spp_prompt_spymaster_profile.format(n = n, target_words = target_words_str, word_list = word_list_str)
-            elif method == "self_refine":
-                phase = kwargs["phase"]
-                if phase == "init":
-                    input_prompt = standard_prompt_spymaster.format(n = n, target_words = target_words_str, word_list = word_list_str)
-                elif phase == "feedback":
-                    input_prompt = self_refine_feedback_prompt.format(question_answer=kwargs["question_answer"])
-                elif phase == "refine":
-                    input_prompt = self_refine_refinement_prompt.format(question_answer=kwargs["question_answer"], feedback=kwargs["feedback"])
-            else:
-                raise NotImplementedError(f"method {method} not implemented for spymaster role")
-        elif role == 'guesser':
-            if method == "standard":
-                input_prompt = standard_prompt_guesser.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "cot":
-                input_prompt = cot_prompt_guesser.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "spp":
-                input_prompt = spp_prompt_guesser.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "spp_less_demo":
-                input_prompt = spp_prompt_guesser_less_demo.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "spp_fixed_persona":
-                input_prompt = spp_prompt_guesser_fixed_persona.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "spp_profile":
-                input_prompt = spp_prompt_guesser_profile.format(n = n, hint_word = hint_word, word_list = word_list_str)
-            elif method == "self_refine":
-                phase = kwargs["phase"]
-                if phase == "init":
-                    input_prompt = standard_prompt_guesser.format(n = n, hint_word = hint_word, word_list = word_list_str)
-                elif phase == "feedback":
-                    input_prompt = self_refine_feedback_prompt.format(question_answer=kwargs["question_answer"])
-                elif phase == "refine":
-                    input_prompt = self_refine_refinement_prompt.format(question_answer=kwargs["question_answer"], feedback=kwargs["feedback"])
-            else:
-                raise NotImplementedError(f"method {method} not implemented for guesser role")
-        else:
-            raise NotImplementedError(f"role {role} not implemented; choose from 'spymaster' or 'guesser'")
-        return input_prompt
+        return super().get_input_prompt(idx, method, **kwargs)
 
     def test_output(self, idx: int, output: str):
         # test whether the output includes all the answers of the trivia questions
@@ -103,6 +49,16 @@ class CodenamesCollaborativeTask(Task):
         info = {"matched_words":common_words, "matched_count":len(common_words), "target_count":len(target_words_set)}
         return info
 
+    def get_stop_predicate(self, method: str, **kwargs):
+        # the answer is one line after the (main) marker that prompt_unwrap splits on
+        if method in ["standard", "cot"]:
+            return get_answer_line_stop("Answer:")
+        elif method in ["spp", "spp_profile", "spp_fixed_persona", "spp_less_demo"]:
+            return get_answer_line_stop("Final answer:")
+        elif method == "self_refine" and kwargs["phase"] != "feedback":
+            return get_answer_line_stop("Answer:")
+        return None
+
     @staticmethod
     def prompt_unwrap(response: str, method: str, **kwargs):
         '''
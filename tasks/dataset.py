@@ -0,0 +1,107 @@
+import os
+import json
+import mmap
+import functools
+from array import array
+
+
+class JsonlDataset:
+    '''
+        lazily loaded jsonl data file, with random access to its records
+            - a byte-offset index of the records is built on first use and cached next to the file (<file>.idx);
+              it is rebuilt when the file changes (size or mtime) or when the index file is corrupted
+            - records are parsed on demand from a read-only mmap of the file, whose pages are shared by all the
+              processes reading the same file
+            - cache_size: number of recently parsed records kept
+    '''
+    def __init__(self, path, cache_size=1024):
+        self.path = path
+        self.cache_size = cache_size
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size > 0 else None
+        self.offsets = self._load_index(stat)
+        self._get_record = functools.lru_cache(maxsize=cache_size)(self._parse_record)
+
+    def _load_index(self, stat):
+        # index file: file size, file mtime, then the start offset of every record and the end of the last one
+        index_path = self.path + ".idx"
+        header = array("Q", [stat.st_size, stat.st_mtime_ns])
+        offsets = self._read_index(index_path, header)
+        if offsets is not None:
+            return offsets
+        offsets = self._build_index()
+        try:
+            tmp_path = index_path + f".tmp{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                (header + offsets).tofile(f)
+            os.replace(tmp_path, index_path)
+        except OSError: # e.g., read-only data directory: just keep the index in memory
+            pass
+        return offsets
+
+    def _read_index(self, index_path, header):
+        # cached offsets, or None when the index file is missing, stale or corrupted (it is then rebuilt)
+        index = array("Q")
+        try:
+            with open(index_path, "rb") as f:
+                index.frombytes(f.read())
+        except (OSError, ValueError): # missing, unreadable, or truncated (not a whole number of offsets)
+            return None
+        offsets = index[2:]
+        if index[:2] != header or not self._is_valid_index(offsets, header[0]):
+            return None
+        return offsets
+
+    def _is_valid_index(self, offsets, size):
+        # the end of the last record is within the file and only blank lines follow it; the last record
+        # starts at the beginning of a line, before its end
+        if len(offsets) == 0 or offsets[-1] > size:
+            return False
+        if self.mm is None:
+            return len(offsets) == 1
+        if self.mm[offsets[-1]:].strip():
+            return False
+        if len(offsets) > 1:
+            start = offsets[-2]
+            if start >= offsets[-1] or (start > 0 and self.mm[start - 1:start] != b"\n"):
+                return False
+        return True
+
+    def _build_index(self):
+        offsets = array("Q")
+        start, end = 0, 0
+        size = len(self.mm) if self.mm is not None else 0
+        while start < size:
+            line_end = self.mm.find(b"\n", start)
+            line_end = size if line_end == -1 else line_end + 1
+            if self.mm[start:line_end].strip(): # skip blank lines
+                offsets.append(start)
+                end = line_end
+            start = line_end
+        offsets.append(end)
+        return offsets
+
+    def _parse_record(self, idx):
+        return json.loads(self.mm[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"index {idx} out of range for {len(self)} records of {self.path}")
+        return self._get_record(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # picklable: only the path is sent, the file is mapped again on the other side
+    def __getstate__(self):
+        return {"path": self.path, "cache_size": self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["cache_size"])
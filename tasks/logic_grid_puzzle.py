@@ -1,8 +1,9 @@
 import os
 import re
-from tasks.base import Task, DATA_PATH
+from tasks.base import Task, DATA_PATH, get_answer_line_stop
 from prompts.logic_grid_puzzle import *
-import json
+from tasks.dataset import JsonlDataset
+from tasks.scoring import SubstringMatcher
 
 
 target_aliases = {
@@ -19,11 +20,12 @@ target_aliases = {
 }
 
 class LogicGridPuzzleTask(Task):
+    name = 'logic_grid_puzzle'
+
     def __init__(self, file='logic_grid_puzzle_200.jsonl'):
         super().__init__()
         path = os.path.join(DATA_PATH, 'logic_grid_puzzle', file)
-        with open(path, "r") as f:
-            self.data = [json.loads(line) for line in f]
+        self.data = JsonlDataset(path)
 
     def __len__(self) -> int:
         return len(self.data)
@@ -31,39 +33,13 @@ class LogicGridPuzzleTask(Task):
     def get_input(self, idx: int):
         return self.data[idx]
 
-    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+    def get_prompt_fields(self, idx: int) -> dict:
         datapoint = self.data[idx]
         input_str = datapoint['inputs']
-        
-        input_str = input_str.replace("\nA:", "")
-
-        if method == "standard":
-            input_prompt = standard_prompt.format(input=input_str)
-        elif method == "cot":    
-            input_prompt = cot_prompt.format(input=input_str)
-        elif method == "spp":
-            input_prompt = spp_prompt.format(input=input_str)
-        elif method == "spp_less_demo":
-            input_prompt = spp_prompt_less_demo.format(input=input_str)
-        elif method == "spp_fixed_persona":
-            input_prompt = spp_prompt_fixed_persona.format(input=input_str)
-        elif method == "spp_profile":
-            input_prompt = spp_prompt_profile.format(input=input_str)
-        elif method == "self_refine":
-            phase = kwargs["phase"]
-            if phase == "init":
-                input_prompt = standard_prompt.format(input=input_str)
-            elif phase == "feedback":
-                input_prompt = self_refine_feedback_prompt.format(question_answer=kwargs["question_answer"])
-            elif phase == "refine":
-                input_prompt = self_refine_refinement_prompt.format(question_answer=kwargs["question_answer"], feedback=kwargs["feedback"])
-        else:
-            raise NotImplementedError(f"method {method} not implemented")
-        
-        return input_prompt
+        return {"input": input_str.replace("\nA:", "")}
 
-    def test_output(self, idx: int, output: str):
-        # test whether the output includes all the answers of the trivia questions
+    def get_answer_matcher(self, idx: int):
+        # groups: the target (and its alias), all other candidates
         instance = self.data[idx]
         target = instance["targets"][0]
         targets = [target]
@@ -76,19 +52,25 @@ class LogicGridPuzzleTask(Task):
             if str(i) not in targets:
                 not_targets.append(str(i))
                 not_targets.append(target_aliases[str(i)])
-        # print("targets", targets)
-        # print("negatives", not_targets)
-        info = {'correct': False}
-        for target in targets:
-            if target.lower().strip() in output.lower().strip(): # if the target is in the output
-                info['correct'] = True
-                # and if all the other targets are not in the output
-                for not_target in not_targets:
-                    if not_target.lower().strip() in output.lower().strip():
-                        info['correct'] = False
-                        break
-                break
-        return info
+        return SubstringMatcher([[t.strip() for t in targets], [t.strip() for t in not_targets]])
+
+    def test_output(self, idx: int, output: str):
+        return self.test_outputs(idx, [output])[0]
+
+    def test_outputs(self, idx: int, outputs: list):
+        # correct if the target is in the output, and all the other candidates are not
+        matcher = self._cached_answer_matcher(idx)
+        return [{'correct': has_target and not has_not_target} for has_target, has_not_target in matcher.match_batch(outputs)]
+
+    def get_stop_predicate(self, method: str, **kwargs):
+        # the answer is one line after the (main) marker that prompt_unwrap splits on
+        if method in ["standard", "cot"]:
+            return get_answer_line_stop("Answer:")
+        elif method in ["spp", "spp_profile", "spp_fixed_persona", "spp_less_demo"]:
+            return get_answer_line_stop("Final answer:")
+        elif method == "self_refine" and kwargs["phase"] != "feedback":
+            return get_answer_line_stop("Answer:")
+        return None
 
     @staticmethod
     def prompt_unwrap(response: str, method: str, **kwargs):
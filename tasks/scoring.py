@@ -0,0 +1,27 @@
+class SubstringMatcher:
+    '''
+        case-insensitive substring matching of groups of patterns (e.g., the aliases of each answer); the patterns are
+        prepared once per instance: lowercased and deduplicated, and a pattern containing a shorter pattern of its
+        group is dropped (it can only occur where the shorter one does, so the group matches either way). An output
+        is lowercased once, then each group is checked with one `in` scan per remaining pattern, stopping at its
+        first match
+            - groups: list of lists of patterns
+        match(output): for each group, whether any of its patterns occurs in the output
+    '''
+    def __init__(self, groups):
+        self.groups = [self._minimal_patterns(group) for group in groups]
+
+    @staticmethod
+    def _minimal_patterns(group):
+        patterns = []
+        for pattern in sorted(set(pattern.lower() for pattern in group), key=len):
+            if not any(shorter in pattern for shorter in patterns):
+                patterns.append(pattern)
+        return patterns
+
+    def match(self, output):
+        output = output.lower()
+        return [any(pattern in output for pattern in group) for group in self.groups]
+
+    def match_batch(self, outputs):
+        return [self.match(output) for output in outputs]
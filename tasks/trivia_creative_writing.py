@@ -2,15 +2,17 @@ import os
 import re
 from tasks.base import Task, DATA_PATH
 from prompts.trivia_creative_writing import *
-import json
+from tasks.dataset import JsonlDataset
+from tasks.scoring import SubstringMatcher
 # from models import gpt
 
 class TriviaCreativeWritingTask(Task):
+    name = 'trivia_creative_writing'
+
     def __init__(self, file='trivia_creative_writing_100_n_5.jsonl'):
         super().__init__()
         path = os.path.join(DATA_PATH, 'trivia_creative_writing', file)
-        with open(path, "r") as f:
-            self.data = [json.loads(line) for line in f]
+        self.data = JsonlDataset(path)
 
     def __len__(self) -> int:
         return len(self.data)
@@ -18,51 +20,23 @@ class TriviaCreativeWritingTask(Task):
     def get_input(self, idx: int):
         return self.data[idx]
 
-    def get_input_prompt(self, idx: int, method: str, **kwargs) -> str:
+    def get_prompt_fields(self, idx: int) -> dict:
         datapoint = self.data[idx]
         questions = datapoint["questions"]
-        topic = datapoint["topic"]
-        n = len(questions)
-        questions_str = " ".join(questions)
-        
-        if method == "standard":
-            input_prompt = standard_prompt.format(n=n, questions=questions_str, topic=topic)
-        elif method == "cot":
-            input_prompt = cot_prompt.format(n=n, questions=questions_str, topic=topic)
-        elif method == "spp":
-            input_prompt = spp_prompt.format(n=n, questions=questions_str, topic=topic)
-        elif method == "spp_less_demo":
-            input_prompt = spp_prompt_less_demo.format(n=n, questions=questions_str, topic=topic)
-        elif method == "spp_fixed_persona":
-            input_prompt = spp_prompt_fixed_persona.format(n=n, questions=questions_str, topic=topic)
-        elif method == "spp_profile":
-            input_prompt = spp_prompt_profile.format(n=n, questions=questions_str, topic=topic)
-        elif method == "self_refine":
-            phase = kwargs["phase"]
-            if phase == "init":
-                input_prompt = standard_prompt.format(n=n, questions=questions_str, topic=topic)
-            elif phase == "feedback":
-                input_prompt = self_refine_feedback_prompt.format(question_answer=kwargs["question_answer"])
-            elif phase == "refine":
-                input_prompt = self_refine_refinement_prompt.format(question_answer=kwargs["question_answer"], feedback=kwargs["feedback"])
-        else:
-            raise NotImplementedError(f"method {method} not implemented")
-        
-        return input_prompt
+        return {"n": len(questions), "questions": " ".join(questions), "topic": datapoint["topic"]}
+
+    def get_answer_matcher(self, idx: int):
+        # one group of aliases per question
+        return SubstringMatcher(self.data[idx]["answers"])
 
     def test_output(self, idx: int, output: str):
-        # test whether the output includes all the answers of the trivia questions
-        instance = self.data[idx]
-        correct_count = 0
-        question_count = len(instance["answers"])
-        for ans_to_question in instance["answers"]:
-            for ans in ans_to_question:
-                # compare all to lower
-                if ans.lower() in output.lower():
-                    correct_count += 1
-                    break
-        info = {'correct_count': correct_count, 'question_count': question_count}
-        return info
+        return self.test_outputs(idx, [output])[0]
+
+    def test_outputs(self, idx: int, outputs: list):
+        # test whether the output includes all the answers of the trivia questions (compared in lower case)
+        matcher = self._cached_answer_matcher(idx)
+        question_count = len(matcher.groups)
+        return [{'correct_count': sum(matched), 'question_count': question_count} for matched in matcher.match_batch(outputs)]
 
     @staticmethod
     def prompt_unwrap(response: str, method: str, **kwargs):
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "scripts")]
+
+
+@pytest.fixture
+def chat_server():
+    # local stub of the chat completions api (scripts/stub_chat_server.py); configure it through its attributes
+    from stub_chat_server import StubChatServer
+    server = StubChatServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,101 @@
+import time
+import threading
+
+import pytest
+
+import models
+from api_client import ChatCompletionsClient, APIError, RequestHandle, RequestCancelled
+from tasks.base import get_answer_line_stop
+
+
+MESSAGES = [{"role": "user", "content": "question"}]
+
+def _get_wrapper(server, **kwargs):
+    return models.OpenAIWrapper(config=dict(models.DEFAULT_GPT_CONFIG), api_key="stub", api_base=server.url, api_type="open_ai", **kwargs)
+
+
+def test_keep_alive_connection_reuse(chat_server):
+    client = ChatCompletionsClient("stub", api_base=chat_server.url, pool_size=2)
+    for _ in range(5):
+        res = client.create("engine", messages=MESSAGES, n=2)
+        assert len(res["choices"]) == 2
+    assert client.pool.num_connections == 1
+    assert chat_server.stats["connections"] == 1
+    client.close()
+
+
+def test_throttled_request_raises_retry_after(chat_server):
+    chat_server.throttle_first, chat_server.retry_after = 1, 0.3
+    client = ChatCompletionsClient("stub", api_base=chat_server.url)
+    with pytest.raises(APIError) as error:
+        client.create("engine", messages=MESSAGES)
+    assert error.value.status_code == 429
+    assert error.value.retry_after == 0.3
+    client.close()
+
+
+def test_retry_honors_retry_after(chat_server):
+    chat_server.throttle_first, chat_server.retry_after = 1, 0.3
+    model = _get_wrapper(chat_server)
+    start_time = time.monotonic()
+    text_outputs, _ = model.run("question")
+    elapsed = time.monotonic() - start_time
+    assert text_outputs and chat_server.stats["requests"] == 2
+    # waited for the Retry-After delay, not the (>= 1s) exponential backoff
+    assert 0.3 <= elapsed < 1.0
+    model.close()
+
+
+def test_retries_are_charged_to_the_rate_limiter(chat_server, monkeypatch):
+    chat_server.throttle_first, chat_server.retry_after = 2, 0.05
+    model = _get_wrapper(chat_server, rate_limit={"rpm": 600, "tpm": 100000})
+    acquired = []
+    acquire = model.rate_limiter.acquire
+    monkeypatch.setattr(model.rate_limiter, "acquire", lambda num_tokens: acquired.append(num_tokens) or acquire(num_tokens))
+    text_outputs, _ = model.run("question")
+    assert text_outputs
+    assert len(acquired) == chat_server.stats["requests"] == 3
+    model.close()
+
+
+def test_refund_charges_usage_beyond_the_reservation():
+    rate_limiter = models.RateLimiter(tpm=6000)
+    assert rate_limiter.acquire(1000) == 1000
+    rate_limiter.refund(-3000) # the response used 4000 tokens
+    assert rate_limiter.available_tokens < 2100
+    rate_limiter.refund(500)
+    assert rate_limiter.available_tokens < 2600
+
+
+def test_stream_early_stop(chat_server):
+    model = _get_wrapper(chat_server, stream=True)
+    text_outputs, raw_responses = model.run("question", n=2, stop_predicate=get_answer_line_stop("Answer:"))
+    assert text_outputs == ["Let me think step by step.\nAnswer: 1\n"] * 2
+    assert [choice["finish_reason"] for choice in raw_responses[0]["choices"]] == ["early_stop"] * 2
+    model.close()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_cancel_frees_pool_slot(chat_server, stream):
+    chat_server.latency = 5.0
+    client = ChatCompletionsClient("stub", api_base=chat_server.url, pool_size=1)
+    handle = RequestHandle()
+    errors = []
+    def send():
+        try:
+            res = client.create("engine", stream=stream, handle=handle, messages=MESSAGES)
+            if stream:
+                list(res)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=send)
+    thread.start()
+    time.sleep(0.3)
+    handle.cancel()
+    thread.join(timeout=2)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], RequestCancelled)
+    # the only slot of the pool is free again
+    chat_server.latency = 0.0
+    assert client.create("engine", messages=MESSAGES)["choices"]
+    client.close()
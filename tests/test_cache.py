@@ -0,0 +1,39 @@
+import os
+
+import models
+from cache import ResponseCache
+from stub_chat_server import StubChatServer
+
+
+REQUEST = {"backend": "gpt", "messages": [{"role": "user", "content": "question"}], "n": 1}
+RESPONSE = {"text_outputs": ["Answer: 1"], "raw_responses": []}
+
+
+def test_read_only_cache_does_not_write(tmp_path):
+    path = str(tmp_path / "cache" / "responses.sqlite")
+    cache = ResponseCache(path, mode="read_only")
+    assert cache.get(REQUEST) is None
+    assert not os.path.exists(os.path.dirname(path))
+
+    ResponseCache(path, mode="write_through").put(REQUEST, RESPONSE)
+    files = {name: os.path.getmtime(os.path.join(os.path.dirname(path), name)) for name in os.listdir(os.path.dirname(path))}
+    cache = ResponseCache(path, mode="read_only", max_size_mb=1)
+    assert cache.get(REQUEST) == RESPONSE
+    cache.put(dict(REQUEST, n=2), RESPONSE)
+    assert cache.get(dict(REQUEST, n=2)) is None
+    assert cache.stats() == {"cache_hits": 1, "cache_misses": 1}
+    assert {name: os.path.getmtime(os.path.join(os.path.dirname(path), name)) for name in os.listdir(os.path.dirname(path))} == files
+
+
+def test_cache_key_includes_the_endpoint(chat_server, tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    other_server = StubChatServer().start()
+    try:
+        for server in [chat_server, chat_server, other_server]:
+            model = models.OpenAIWrapper(config=dict(models.DEFAULT_GPT_CONFIG), cache=cache, api_key="stub", api_base=server.url, api_type="open_ai")
+            assert model.run("question")[0]
+            model.close()
+        assert chat_server.stats["requests"] == 1
+        assert other_server.stats["requests"] == 1
+    finally:
+        other_server.stop()
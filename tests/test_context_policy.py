@@ -0,0 +1,36 @@
+import pytest
+
+import run
+from models import estimate_num_tokens
+
+
+QUESTION = "Solve the puzzle step by step. " * 8
+# "\n" + A0, then the "feedback + revised answer" of each refinement round (see run._run_self_refine_default)
+HISTORY = ["\n" + "first answer. " * 20] + [f"\nfeedback {k}: " + "check the clues again. " * (5 * k) + f"\nrevised answer {k}." for k in range(1, 6)]
+
+def _get_num_rounds(context):
+    # number of the most recent rounds of HISTORY kept after the question
+    for num_rounds in range(len(HISTORY) + 1):
+        if context == QUESTION + "".join(HISTORY[len(HISTORY) - num_rounds:]):
+            return num_rounds
+    raise AssertionError("the context is not the question followed by the most recent rounds")
+
+def _get_num_tokens(num_rounds):
+    return sum(estimate_num_tokens(text) for text in [QUESTION] + HISTORY[len(HISTORY) - num_rounds:])
+
+
+@pytest.mark.parametrize("context_token_budget", [0, 100, 350, 450, 500, 550, 650, 10000])
+def test_window_context_fits_budget_and_keeps_latest_round(context_token_budget):
+    context = run._get_context_prompt(QUESTION, HISTORY, HISTORY[-1], context_policy="window", context_token_budget=context_token_budget)
+    num_rounds = _get_num_rounds(context)
+    assert num_rounds >= 1
+    if num_rounds > 1:
+        assert _get_num_tokens(num_rounds) <= context_token_budget
+    # as many rounds as fit
+    if num_rounds < len(HISTORY):
+        assert _get_num_tokens(num_rounds + 1) > context_token_budget
+
+
+def test_window_context_with_large_budget_is_full_context():
+    context = run._get_context_prompt(QUESTION, HISTORY, HISTORY[-1], context_policy="window", context_token_budget=10000)
+    assert context == run._get_context_prompt(QUESTION, HISTORY, HISTORY[-1], context_policy="full")
@@ -0,0 +1,47 @@
+from array import array
+
+import pytest
+
+from tasks.dataset import JsonlDataset
+
+
+RECORDS = [{"idx": i, "text": "x" * (i + 1)} for i in range(5)]
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.jsonl"
+    path.write_text("".join(f'{{"idx": {r["idx"]}, "text": "{r["text"]}"}}\n' for r in RECORDS) + "\n")
+    JsonlDataset(str(path)) # builds and caches the index
+    return path
+
+
+def test_cached_index_is_reused(data_file):
+    index_file = str(data_file) + ".idx"
+    with open(index_file, "rb") as f:
+        index = f.read()
+    assert list(JsonlDataset(str(data_file))) == RECORDS
+    with open(index_file, "rb") as f:
+        assert f.read() == index
+
+
+def test_truncated_index_is_rebuilt(data_file):
+    index_file = str(data_file) + ".idx"
+    with open(index_file, "rb") as f:
+        index = f.read()
+    with open(index_file, "wb") as f:
+        f.write(index[:-3])
+    assert list(JsonlDataset(str(data_file))) == RECORDS
+    with open(index_file, "rb") as f:
+        assert f.read() == index
+
+
+@pytest.mark.parametrize("offsets", [[], [0, 10 ** 6], [0, 5], [0, 7, 1]])
+def test_index_not_matching_the_file_is_rebuilt(data_file, offsets):
+    # up-to-date header (size, mtime), wrong offsets
+    index_file = str(data_file) + ".idx"
+    with open(index_file, "rb") as f:
+        index = array("Q")
+        index.frombytes(f.read())
+    with open(index_file, "wb") as f:
+        (index[:2] + array("Q", offsets)).tofile(f)
+    assert list(JsonlDataset(str(data_file))) == RECORDS
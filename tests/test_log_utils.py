@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from log_utils import LOG_FORMATS, PROMPT_STORE_DIR, JsonlLogWriter, get_log_codec, read_logs
+from prompts.registry import get_prompt_prefixes
+
+
+CONFIG = {"model": "gpt4-32k", "method": "spp", "task": "logic_grid_puzzle", "num_generation": 2}
+
+def _get_logs():
+    # records as logged by run.py: run outputs, then the run config, then the task data
+    prefix = get_prompt_prefixes("logic_grid_puzzle")[0]
+    logs = []
+    for i in range(3):
+        raw_response = [{"prompt": prefix + f"question {i}", "choices": [{"message": {"content": "Answer: 1"}}]}]
+        log = {"idx": i, "raw_response": raw_response, "unwrapped_output": ["1"], **CONFIG, "task_data": {"inputs": f"question {i}"}}
+        logs.append(log)
+    logs[2]["num_generation"] = 1 # config fields that differ from the header are kept in the record
+    return logs
+
+
+def test_compact_log_codec_round_trip(tmp_path):
+    log_file = os.path.join(tmp_path, "run.jsonl.gz")
+    codec = get_log_codec(log_file, CONFIG)
+    for log in _get_logs():
+        record = codec.encode(log)
+        assert "method" not in record
+        assert set(record["raw_response"][0]["prompt"]) == {"prefix", "text"}
+        assert list(codec.decode(record).items()) == list(log.items())
+    assert codec.encode(_get_logs()[2])["num_generation"] == 1
+    assert len(os.listdir(os.path.join(tmp_path, PROMPT_STORE_DIR))) == 1
+
+
+@pytest.mark.parametrize("log_format", ["jsonl", "gzip", "zstd"])
+def test_log_file_round_trip(tmp_path, log_format):
+    if log_format == "zstd":
+        pytest.importorskip("zstandard")
+    log_file = os.path.join(tmp_path, "run.jsonl" + LOG_FORMATS[log_format])
+    codec = get_log_codec(log_file, CONFIG)
+    with JsonlLogWriter(log_file, codec=codec, header=codec.header if codec is not None else None) as log_writer:
+        for log in _get_logs():
+            log_writer.write(log)
+    assert [list(log.items()) for log in read_logs(log_file)] == [list(log.items()) for log in _get_logs()]
@@ -0,0 +1,44 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+import results
+
+
+def _write_log(log_file, correct):
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, "w") as f:
+        for i, flags in enumerate(correct):
+            log = {"idx": i, "parsing_success_flag": [True] * len(flags), "test_output_infos": [{"correct": flag} for flag in flags],
+                   "task": "logic_grid_puzzle", "method": "spp", "model": "gpt4-32k", "gpt_config": {"engine": "devgpt4-32k"}, "system_message": ""}
+            f.write(json.dumps(log) + "\n")
+
+
+@pytest.fixture
+def npz_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, "_pyarrow", False) # the numpy fallback
+    log_dir = tmp_path / "logs"
+    _write_log(str(log_dir / "a.jsonl"), [[True, False], [True, True]])
+    _write_log(str(log_dir / "b.jsonl"), [[False, False]])
+    store = results.ResultsStore(log_dir=str(log_dir), cache_path=str(tmp_path / "results"))
+    store.refresh()
+    return store
+
+
+def test_npz_cache_stores_string_columns_as_codes(npz_store):
+    with np.load(npz_store.cache_path, allow_pickle=False) as data:
+        assert "log_file" not in data.files
+        assert data["log_file" + results.CODES_SUFFIX].dtype == np.int32
+        assert len(data["log_file" + results.CATEGORIES_SUFFIX]) == 2
+
+
+def test_npz_cache_round_trip(npz_store):
+    reloaded = results.ResultsStore(log_dir=npz_store.log_dir, cache_path=npz_store.cache_path[:-len(".npz")])
+    assert reloaded.manifest == npz_store.manifest
+    for column, values in npz_store.columns.items():
+        assert reloaded.columns[column].tolist() == values.tolist()
+    assert reloaded.refresh() == []
+    assert reloaded.query("accuracy") == [{"task": "logic_grid_puzzle", "method": "spp", "engine": "devgpt4-32k", "system_message": "without",
+                                           "accuracy": 0.5, "num_records": 3}]
@@ -0,0 +1,85 @@
+import sys
+import json
+
+import pytest
+
+import run
+from conftest import ROOT_DIR
+from configs import gpt_configs
+from log_utils import find_shard_log_files
+
+
+def _get_args(monkeypatch, output_dir, *argv):
+    monkeypatch.setattr(sys, "argv", ["run.py", "--model", "gpt4-32k", "--method", "standard", "--task", "logic_grid_puzzle",
+                                      "--task_data_file", "logic_grid_puzzle_200.jsonl", "--task_start_index", "0", "--task_end_index", "4",
+                                      "--output_dir", str(output_dir), *argv])
+    args = vars(run.parse_args())
+    args['gpt_config'] = dict(gpt_configs[args['model']], temperature=args['temperature'], top_p=args['top_p'])
+    return args
+
+def _read_lines(log_file):
+    with open(log_file, "r") as f:
+        return f.readlines()
+
+
+def test_resume_skips_completed_and_reruns_failed(chat_server, monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT_DIR) # task data paths are relative to the repo root
+    monkeypatch.setenv("API_BASE", chat_server.url)
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    args = _get_args(monkeypatch, tmp_path)
+    run.run(args)
+    log_file = run._get_log_file(args)
+    lines = _read_lines(log_file)
+    assert chat_server.stats["requests"] == 4
+
+    # instance 1 failed (no "idx"), instance 2 only got some of its generations, the last line was cut short
+    failed = json.loads(lines[1])
+    failed = {key: value for key, value in failed.items() if key in args or key == "task_data"}
+    partial = dict(json.loads(lines[2]), partial=True)
+    with open(log_file, "w") as f:
+        f.writelines([lines[0], json.dumps(failed) + "\n", json.dumps(partial) + "\n", lines[3][:len(lines[3]) // 2]])
+
+    run.run(_get_args(monkeypatch, tmp_path, "--resume"))
+    resumed_lines = _read_lines(log_file)
+    assert chat_server.stats["requests"] == 4 + 3
+    assert [json.loads(line)["idx"] for line in resumed_lines] == [0, 1, 2, 3]
+    assert resumed_lines[0] == lines[0]
+    assert not any(json.loads(line).get("partial") for line in resumed_lines)
+
+
+def test_sharded_run_keeps_completed_shards_when_a_worker_fails(chat_server, monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT_DIR)
+    monkeypatch.setenv("API_BASE", chat_server.url)
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    # record the responses replayed by the sharded run; the recording of instance 3 is broken (no usage)
+    record_dir = tmp_path / "recorded" / "logic_grid_puzzle"
+    run.run(_get_args(monkeypatch, record_dir))
+    recorded_file = run._get_log_file(_get_args(monkeypatch, record_dir))
+    lines = _read_lines(recorded_file)
+    broken = json.loads(lines[3])
+    del broken["raw_response"][0]["usage"]
+    with open(recorded_file, "w") as f:
+        f.writelines(lines[:3] + [json.dumps(broken) + "\n"])
+
+    # shard 0 runs instances 0-1, shard 1 runs instance 2, then fails on instance 3
+    replay_argv = ["--model_type", "replay", "--replay_dir", str(tmp_path / "recorded"), "--num_workers", "2"]
+    args = _get_args(monkeypatch, tmp_path / "replay", *replay_argv)
+    log_file = run._get_log_file(args)
+    with pytest.raises(KeyError):
+        run.run(args)
+    assert [json.loads(line)["idx"] for line in _read_lines(log_file)] == [0, 1, 2]
+    assert find_shard_log_files(log_file) == []
+
+    # a killed run leaves its shard files behind: --resume merges their completed records
+    merged_lines = _read_lines(log_file)
+    with open(log_file, "w") as f:
+        f.writelines(merged_lines[:2])
+    with open(log_file + ".shard1", "w") as f:
+        f.write(merged_lines[2])
+    with open(recorded_file, "w") as f:
+        f.writelines(lines)
+    run.run(_get_args(monkeypatch, tmp_path / "replay", *replay_argv, "--resume"))
+    resumed_lines = _read_lines(log_file)
+    assert [json.loads(line)["idx"] for line in resumed_lines] == [0, 1, 2, 3]
+    assert resumed_lines[:3] == merged_lines
+    assert find_shard_log_files(log_file) == []